@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Timings and counts written by check_for_updates.py and handle_updates.py (see --stats-file)
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Timings and counts for the current iteration, and in total."""
+    
+    def __init__(self, prefix):
+        self.prefix = prefix # of the metric names in the Prometheus format
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.iterations = 0
+        self.total_phases = {}
+        self.total_counters = {}
+        self.total_subprocesses = {}
+        self.reset()
+    
+    def reset(self):
+        """Starts a new iteration. The totals are kept."""
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.counters = {}
+            self.subprocesses = {}
+    
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                for phases in (self.phases, self.total_phases):
+                    phases[name] = phases.get(name, 0) + duration
+                if name == "iteration":
+                    self.iterations += 1
+    
+    @contextmanager
+    def subprocess(self, command):
+        program = os.path.basename(command[0])
+        arguments = list(command[1:])
+        while program == "git" and arguments[:1] and arguments[0].startswith("-"):
+            # skip global options, so that for instance `git --no-pager diff` is counted as `git diff`
+            arguments = arguments[2:] if arguments[0] in ("-c", "-C") else arguments[1:]
+        name = program + " " + arguments[0] if program in ("git", "docker") and arguments else program
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                for subprocesses in (self.subprocesses, self.total_subprocesses):
+                    stats = subprocesses.setdefault(name, {"count": 0, "seconds": 0, "max_seconds": 0})
+                    stats["count"] += 1
+                    stats["seconds"] += duration
+                    stats["max_seconds"] = max(stats["max_seconds"], duration)
+    
+    def count(self, name, value=1):
+        with self.lock:
+            for counters in (self.counters, self.total_counters):
+                counters[name] = counters.get(name, 0) + value
+    
+    def as_dict(self):
+        """Returns the metrics of the current iteration."""
+        with self.lock:
+            return {
+                "started": self.started,
+                "iterations": self.iterations,
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                "subprocesses": {name: dict(stats) for name, stats in self.subprocesses.items()},
+            }
+    
+    def prometheus(self):
+        """Returns the totals in the Prometheus textfile format."""
+        prefix = self.prefix
+        with self.lock:
+            lines = [
+                "# TYPE " + prefix + "_iterations_total counter",
+                prefix + "_iterations_total " + str(self.iterations),
+                "# TYPE " + prefix + "_last_iteration_timestamp_seconds gauge",
+                prefix + "_last_iteration_timestamp_seconds " + str(self.started),
+                "# TYPE " + prefix + "_phase_seconds_total counter",
+            ]
+            lines += ['%s_phase_seconds_total{phase="%s"} %f' % (prefix, name, value) for name, value in sorted(self.total_phases.items())]
+            for name, value in sorted(self.total_counters.items()):
+                lines.append("# TYPE " + prefix + "_" + name + "_total counter")
+                lines.append("%s_%s_total %d" % (prefix, name, value))
+            for metric, key in [("subprocess_calls_total", "count"), ("subprocess_seconds_total", "seconds")]:
+                lines.append("# TYPE " + prefix + "_" + metric + " counter")
+                lines += ['%s_%s{command="%s"} %g' % (prefix, metric, name, stats[key]) for name, stats in sorted(self.total_subprocesses.items())]
+        return "\n".join(lines) + "\n"
+    
+    def write(self, filename):
+        """Writes the totals in the Prometheus textfile format if the filename ends with .prom, otherwise the current iteration as JSON."""
+        if filename.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.as_dict(), indent=2, sort_keys=True) + "\n"
+        with self.write_lock:
+            with open(filename + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(filename + ".tmp", filename)
@@ -13,26 +13,53 @@ if sys.version_info[0] != 3:
     sys.exit(1)
 
 from urllib.parse import urlparse
+from shlex import quote as shell_quote
 import argparse
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import hashlib
+import io
 import os
 import shutil
+import random
 import re
+import resource
+import select
 import json
+import logging
+import mmap
+import struct
 import tempfile
 import time
 import traceback
+import tracemalloc
 from dateutil import parser
-from datetime import datetime, timedelta
+from datetime import datetime
+from collections import namedtuple
 from pprint import pprint
-from subprocess import call, check_call, check_output
+from subprocess import CalledProcessError, STDOUT
+from contextlib import contextmanager
 import socket
+from archive_metrics import Metrics
+import sqlite3
+import subprocess
+import threading
+
+log = logging.getLogger("check_for_updates")
+remote_lock = threading.Lock() # held while talking to the remote, as pushing, fetching and merging can not be done at the same time
 
 
 def main(argv):
     # get lock to avoid multiple simultaneous instances of this script
-    get_lock(os.path.basename(__file__))
+    # (except for the offload filter, which is started by git while this script is running)
+    if argv[:1] != ["offload-filter"]:
+        get_lock(os.path.basename(__file__))
     
     if '--run-tests' in argv:
+        configure_logging("INFO")
         run_tests("--forever" in argv)
     else:
         parser = argparse.ArgumentParser(description="Monitors a book archive and commits changes to git.")
@@ -41,14 +68,64 @@ def main(argv):
         parser_update = subparsers.add_parser("update", help="Check archive for changes.")
         parser_update.add_argument("archive", help="Path to the archive.", metavar="PATH")
         parser_update.add_argument("-f", "--forever", help="Loop script forever.", action='store_true')
+        parser_update.add_argument("-w", "--watch", help="Use inotify to only check books that have changed (requires --forever).", action='store_true')
+        parser_update.add_argument("--full-rescan-interval", help="When watching, check all books at least this often (default: 3600).", metavar="SECONDS", type=int, default=3600)
+        parser_update.add_argument("--push-batch-size", help="Push after this many commits; 0 means once per iteration (default: 1).", metavar="N", type=int, default=1)
+        parser_update.add_argument("--push-batch-time", help="Push when the oldest unpushed commit is this old, even if the batch is not full.", metavar="SECONDS", type=float, default=None)
+        parser_update.add_argument("--workers", help="Number of threads used to scan books (default: 1).", metavar="N", type=int, default=1)
+        parser_update.add_argument("--manifest", help="Detect changes by comparing file sizes and content hashes instead of modification times.", action='store_true')
+        parser_update.add_argument("--hash-workers", help="Number of threads used to hash the files of a book with --manifest (default: number of CPUs).", metavar="N", type=int, default=os.cpu_count() or 1)
+        parser_update.add_argument("--quiet-period", help="Only commit a changed book once it has not changed for this long (default: 0).", metavar="SECONDS", type=float, default=0)
+        parser_update.add_argument("--max-settle-time", help="Commit a changed book after this long even if it keeps changing (default: 600).", metavar="SECONDS", type=float, default=600)
+        parser_update.add_argument("--async-push", help="Scan, commit and push in separate threads, so a slow remote does not hold up scanning.", action='store_true')
+        parser_update.add_argument("--maintenance", help="Repack, write commit-graphs etc. while the archive is idle.", action='store_true')
+        parser_update.add_argument("--porcelain", help="Use only porcelain git commands (git commit etc.) instead of long-lived git processes and plumbing.", action='store_true')
+        parser_update.add_argument("--offload-store", help="Store large media files in this content-addressed directory, and commit small pointer files instead.", metavar="DIR")
+        parser_update.add_argument("--offload-threshold", help="Offload files of at least this size (default: 1000000).", metavar="BYTES", type=int, default=1000000)
+        parser_update.add_argument("--offload-pattern", help="Offload files matching this pattern regardless of size, for instance 'daisy202/*.wav'. Can be repeated.", metavar="PATTERN", action='append', default=[])
+        parser_update.add_argument("--batch-merge", help="Merge all tagged branches with a single pull and push.", action='store_true')
+        parser_update.add_argument("--stats-file", help="Write timings and counts for each iteration to this file; Prometheus textfile format if it ends with .prom, otherwise JSON.", metavar="FILE")
+        parser_update.add_argument("--log-level", help="DEBUG, INFO, WARNING or ERROR (default: INFO).", default="INFO")
         parser_update.set_defaults(func=update)
         
         parser_init = subparsers.add_parser("git-init", help="Initialize archive from remote git repository.")
         parser_init.add_argument("archive", help="Path to the archive.", metavar="PATH")
         parser_init.add_argument("git_url", help="Initialize the archive from this git repository.", metavar="URL")
+        parser_init.add_argument("--offload-store", help="Store large media files in this content-addressed directory, and commit small pointer files instead.", metavar="DIR")
+        parser_init.add_argument("--offload-threshold", help="Offload files of at least this size (default: 1000000).", metavar="BYTES", type=int, default=1000000)
+        parser_init.add_argument("--offload-pattern", help="Offload files matching this pattern regardless of size, for instance 'daisy202/*.wav'. Can be repeated.", metavar="PATTERN", action='append', default=[])
+        parser_init.add_argument("--depth", help="Only fetch this many commits of history.", metavar="N", type=int)
+        parser_init.add_argument("--filter", help="Partial clone filter, for instance 'blob:none' to only fetch file contents when they are checked out.", metavar="FILTER")
+        parser_init.add_argument("--sparse", help="Only check out this format directory, for instance 'daisy202'. Can be repeated.", metavar="FORMAT", action='append', default=[])
+        parser_init.add_argument("--resume", help="Initialize with git init and git fetch so that an interrupted initialization can be continued by running the same command again.", action='store_true')
+        parser_init.add_argument("--retries", help="With --resume, retry a failed fetch this many times (default: 3).", metavar="N", type=int, default=3)
+        parser_init.add_argument("--fetch-step", help="With --resume, fetch the history this many commits at a time, so that an interrupted fetch only loses the last step (default: 100).", metavar="N", type=int, default=100)
+        parser_init.add_argument("--timeout", help="Timeout for each clone, fetch and checkout (default: 3600).", metavar="SECONDS", type=int, default=3600)
         parser_init.set_defaults(func=git_init)
         
+        parser_filter = subparsers.add_parser("offload-filter", help="Git filter process used for offloaded media (started by git).")
+        parser_filter.add_argument("--store", help="The content-addressed store.", metavar="DIR", required=True)
+        parser_filter.add_argument("--threshold", help="Offload files of at least this size.", metavar="BYTES", type=int, required=True)
+        parser_filter.add_argument("--pattern", help="Offload files matching this pattern regardless of size.", metavar="PATTERN", action='append', default=[])
+        parser_filter.set_defaults(func=offload_filter)
+        
+        parser_benchmark = subparsers.add_parser("benchmark", help="Measure update performance on a generated archive.")
+        parser_benchmark.add_argument("--books", help="Number of books to generate (default: 1000).", metavar="N", type=int, default=1000)
+        parser_benchmark.add_argument("--files-per-book", help="Number of files in each book, including the media file (default: 10).", metavar="N", type=int, default=10)
+        parser_benchmark.add_argument("--media-size", help="Size of the audio.wav file in each book; 0 for no media (default: 1000000).", metavar="BYTES", type=int, default=1000000)
+        parser_benchmark.add_argument("--formats", help="Comma separated list of format directories (default: daisy202,epub3).", default="daisy202,epub3")
+        parser_benchmark.add_argument("--change-fraction", help="Fraction of the books changed in each scenario (default: 0.01).", metavar="FRACTION", type=float, default=0.01)
+        parser_benchmark.add_argument("--workers", help="Number of threads used to scan books (default: 1).", metavar="N", type=int, default=1)
+        parser_benchmark.add_argument("--manifest", help="Detect changes with content hashes (see update --manifest).", action='store_true')
+        parser_benchmark.add_argument("--porcelain", help="Use only porcelain git commands (see update --porcelain).", action='store_true')
+        parser_benchmark.add_argument("--push-batch-size", help="Push after this many commits; 0 means once per iteration (default: 1).", metavar="N", type=int, default=1)
+        parser_benchmark.add_argument("--directory", help="Create the archive in this (empty or non-existing) directory instead of a temporary one, and keep it.", metavar="PATH")
+        parser_benchmark.add_argument("--keep", help="Keep the temporary directory.", action='store_true')
+        parser_benchmark.add_argument("--output", help="Write the results as JSON to this file.", metavar="FILE")
+        parser_benchmark.set_defaults(func=benchmark)
+        
         args = parser.parse_args()
+        configure_logging(getattr(args, "log_level", "INFO"), sys.stderr if getattr(args, "func", None) == offload_filter else sys.stdout)
         if "func" in args:
             args.func(args)
         else:
@@ -60,10 +137,44 @@ def git_init(args):
     print("---------------------------")
     print("  initialize archive       ")
     print("---------------------------")
+    timeout = getattr(args, "timeout", 3600)
+    depth = getattr(args, "depth", None)
+    clone_filter = getattr(args, "filter", None)
+    sparse = getattr(args, "sparse", None) or []
+    offload = bool(getattr(args, "offload_store", None))
     print("Will attempt to clone archive.")
-    print("Note that if it runs for more than an hour this process will time out and fail.")
-    print("You can clone the repository manually if the timeout is a problem.")
-    check_call(["git", "clone", args.git_url, os.path.basename(args.archive)], cwd=os.path.dirname(args.archive), timeout=3600)
+    print("Note that if a git command runs for more than "+str(timeout)+" seconds this process will time out and fail.")
+    print("You can use --depth, --filter and --sparse to download less, and --resume to continue if the timeout is a problem.")
+    
+    resume = getattr(args, "resume", False)
+    if resume:
+        git_init_resumable(args, timeout)
+    else:
+        clone_options = []
+        if depth:
+            clone_options += ["--depth", str(depth)]
+        if clone_filter:
+            clone_options += ["--filter", clone_filter]
+        if depth:
+            clone_options += ["--no-single-branch"] # also fetch other branches, so that they can be merged
+        if sparse or offload:
+            clone_options += ["--no-checkout"]
+        check_call(["git", "clone"] + clone_options + [args.git_url, os.path.basename(args.archive)], cwd=os.path.dirname(args.archive), timeout=timeout)
+    
+    if sparse:
+        print("Only checking out: "+", ".join(sparse))
+        check_call(["git", "sparse-checkout", "set", "--cone"] + sparse, cwd=args.archive, timeout=60)
+    if offload:
+        # configure the filter before checking out, so that offloaded media is restored from the store
+        configure_offload_filter(args)
+    if resume:
+        # only check out while HEAD is unborn, so that resuming never touches an existing checkout
+        checkout = call(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=args.archive, stdout=subprocess.DEVNULL, timeout=60) != 0
+    else:
+        checkout = sparse or offload
+    if checkout and call(["git", "rev-parse", "--verify", "-q", "origin/master"], cwd=args.archive, stdout=subprocess.DEVNULL, timeout=60) == 0:
+        check_call(["git", "checkout", "master"], cwd=args.archive, timeout=timeout)
+    
     gitignore_filepath = os.path.join(args.archive, ".gitignore")
     gitignore = []
     if os.path.exists(gitignore_filepath):
@@ -78,31 +189,143 @@ def git_init(args):
         check_call(["git", "add", os.path.relpath(gitignore_filepath, args.archive)], cwd=args.archive, timeout=60)
         check_call(["git", "commit", "-m", "Added .db/ to .gitignore"], cwd=args.archive, timeout=60)
         check_call(["git", "push"], cwd=args.archive, timeout=60)
+    if offload:
+        configure_offload(args)
+
+
+def git_init_resumable(args, timeout):
+    """Initializes the archive with `git init` and `git fetch` in `--fetch-step` steps, so that an interrupted initialization can be resumed."""
+    if os.path.isdir(os.path.join(args.archive, ".git")):
+        print("Resuming initialization of "+args.archive)
+    else:
+        os.makedirs(args.archive, exist_ok=True)
+        check_call(["git", "init", "-q"], cwd=args.archive, timeout=60)
+        check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=args.archive, timeout=60)
+    remotes = check_output(["git", "remote"], cwd=args.archive, universal_newlines=True, timeout=60).split()
+    if "origin" not in remotes:
+        check_call(["git", "remote", "add", "origin", args.git_url], cwd=args.archive, timeout=60)
+    check_call(["git", "config", "branch.master.remote", "origin"], cwd=args.archive, timeout=60)
+    check_call(["git", "config", "branch.master.merge", "refs/heads/master"], cwd=args.archive, timeout=60)
+    if getattr(args, "filter", None):
+        check_call(["git", "config", "remote.origin.promisor", "true"], cwd=args.archive, timeout=60)
+        check_call(["git", "config", "remote.origin.partialclonefilter", args.filter], cwd=args.archive, timeout=60)
+    
+    depth = getattr(args, "depth", None)
+    step = max(1, getattr(args, "fetch_step", 100))
+    filter_options = ["--filter", args.filter] if getattr(args, "filter", None) else []
+    fetched_depth = 0
+    if call(["git", "rev-parse", "--verify", "-q", "origin/master"], cwd=args.archive, stdout=subprocess.DEVNULL, timeout=60) == 0:
+        fetched_depth = int(check_output(["git", "config", "--default", "0", "archive.fetchedDepth"], cwd=args.archive, universal_newlines=True, timeout=60).strip())
+    while True:
+        if fetched_depth and depth and fetched_depth >= depth:
+            break
+        if fetched_depth and check_output(["git", "rev-parse", "--is-shallow-repository"], cwd=args.archive, universal_newlines=True, timeout=60).strip() != "true":
+            break # all of the history has been fetched
+        commits = min(step, depth - fetched_depth) if depth else step
+        print("Fetching commits "+str(fetched_depth + 1)+" to "+str(fetched_depth + commits)+(" of "+str(depth) if depth else ""))
+        fetch_with_retries(args, ["--depth", str(commits)] if not fetched_depth else ["--deepen", str(commits)], filter_options, timeout)
+        fetched_depth += commits
+        check_call(["git", "config", "archive.fetchedDepth", str(fetched_depth)], cwd=args.archive, timeout=60)
+
+
+def fetch_with_retries(args, depth_options, fetch_options, timeout):
+    """Fetches from origin, retrying up to `--retries` times with an increasing delay."""
+    retries = getattr(args, "retries", 3)
+    for attempt in range(retries + 1):
+        try:
+            check_call(["git", "fetch", "origin"] + depth_options + fetch_options, cwd=args.archive, timeout=timeout)
+            return
+        except (CalledProcessError, subprocess.TimeoutExpired) as e:
+            if attempt == retries:
+                raise
+            print("Fetch failed ("+str(e)+"); retrying ("+str(attempt + 1)+" of "+str(retries)+")")
+            time.sleep(min(300, 10 * 2 ** attempt))
+
+
+def configure_offload(args):
+    """Configures the offload filter, and makes sure .gitattributes sends all files through it."""
+    configure_offload_filter(args)
+    gitattributes_filepath = os.path.join(args.archive, ".gitattributes")
+    gitattributes = []
+    if os.path.exists(gitattributes_filepath):
+        with open(gitattributes_filepath) as f:
+            gitattributes = f.readlines()
+    if "* filter="+OFFLOAD_FILTER+"\n" not in gitattributes:
+        with open(gitattributes_filepath, "a") as f:
+            f.write("\n")
+            f.write("# store large media outside of git (see offload-filter in check_for_updates.py)\n")
+            f.write("* filter="+OFFLOAD_FILTER+"\n")
+        check_call(["git", "reset"], cwd=args.archive, timeout=60)
+        check_call(["git", "add", os.path.relpath(gitattributes_filepath, args.archive)], cwd=args.archive, timeout=60)
+        check_call(["git", "commit", "-m", "Added offload filter to .gitattributes"], cwd=args.archive, timeout=60)
+        check_call(["git", "push"], cwd=args.archive, timeout=60)
+
+
+def configure_offload_filter(args):
+    store = os.path.abspath(args.offload_store)
+    os.makedirs(store, exist_ok=True)
+    command = [sys.executable, os.path.realpath(__file__), "offload-filter", "--store", store, "--threshold", str(args.offload_threshold)]
+    for pattern in args.offload_pattern:
+        command += ["--pattern", pattern]
+    check_call(["git", "config", "filter."+OFFLOAD_FILTER+".process", " ".join(shell_quote(part) for part in command)], cwd=args.archive, timeout=60)
+    check_call(["git", "config", "filter."+OFFLOAD_FILTER+".required", "true"], cwd=args.archive, timeout=60)
 
 
 def update(args):
+    if getattr(args, "offload_store", None):
+        args = normalize_args(args)
+        configure_offload(args)
+    if getattr(args, "quiet_period", 0):
+        args.settle_tracker = SettleTracker(args.quiet_period, args.max_settle_time)
+    if getattr(args, "async_push", False):
+        args = normalize_args(args)
+        args.pusher = BackgroundPusher(args)
     if args.forever:
+        if args.watch:
+            args = normalize_args(args)
+            args.watcher = ArchiveWatcher(args.archive, args.full_rescan_interval)
         while True:
             print()
             print("============================================================")
             print("Iteration start time: "+datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f UTC")+"\n")
             print()
             
+            delay = 5
             try:
-                update_iteration(args)
+                delay = update_iteration(args)
             except Exception as e:
                 print("An exception occured while updating!")
                 print()
                 traceback.print_exc(file=sys.stdout)
-            time.sleep(5)
+            if getattr(args, "watcher", None) is not None:
+                args.watcher.wait(delay)
+            else:
+                time.sleep(delay)
             
             print("============================================================")
             print()
     else:
-        update_iteration(args)
+        try:
+            update_iteration(args)
+        finally:
+            if getattr(args, "repository", None) is not None:
+                args.repository.close()
+                args.repository = None
+            if getattr(args, "pusher", None) is not None and not args.pusher.flush(timeout=300):
+                raise Exception("Unable to push the commits to the remote")
     
 
 def update_iteration(args):
+    metrics.reset()
+    try:
+        with metrics.phase("iteration"):
+            return update_iteration_phases(args)
+    finally:
+        if getattr(args, "stats_file", None):
+            metrics.write(args.stats_file)
+
+
+def update_iteration_phases(args):
     print("---------------------------")
     print("  check for updates        ")
     print("---------------------------")
@@ -127,114 +350,1289 @@ def update_iteration(args):
     db_dir = os.path.join(args.archive, ".db")
     
     if (not os.path.isdir(db_dir)):
-        print("Creating JSON database folder: "+db_dir)
+        print("Creating database folder: "+db_dir)
         os.mkdir(db_dir, mode=0o755)
     
-    main_db_filename = db_dir+"/_main.json" # assume no book will ever have the UID "_main"
-    main_db = load_data(main_db_filename)
-    
-    # Determine if git fetch/pull should be performed
-    last_git_fetch = None
-    should_git_fetch = False
-    if ("last_git_fetch" in main_db):
-        last_git_fetch = parser.parse(main_db["last_git_fetch"])
-    else:
-        last_git_fetch = datetime.utcnow() - timedelta(days=1)
-    if (last_git_fetch > datetime.utcnow() - timedelta(minutes=10)):
-        # the previous git fetch for the book has changed
-        main_db["last_git_fetch"] = str(datetime.utcnow())
-        save_data(main_db_filename, main_db)
-        should_git_fetch = True
+    if not getattr(args, "porcelain", False) and getattr(args, "repository", None) is None:
+        args.repository = GitRepository(args.archive)
     
+    index = ArchiveIndex(db_dir)
+    try:
+        scheduler = Scheduler(index, force=not args.forever)
+        watcher = getattr(args, "watcher", None)
+        if scheduler.due("scan") or (watcher is not None and watcher.has_changes()):
+            commits = update_books(args, index)
+            settling = getattr(args, "settle_tracker", None) is not None and bool(args.settle_tracker.pending)
+            scheduler.done("scan", commits > 0 or settling)
+        
+        print("---------------------------")
+        print("  check for pull requests  ")
+        print("---------------------------")
+        fetched = False
+        if scheduler.due("fetch"):
+            with remote_lock_if_free() as locked:
+                if locked:
+                    with metrics.phase("fetch"):
+                        fetch_output = check_output(["git", "fetch"], cwd=args.archive, universal_newlines=True, stderr=STDOUT, timeout=3600)
+                    print(fetch_output, end="")
+                    fetched = bool(fetch_output.strip())
+                    scheduler.done("fetch", fetched)
+                else:
+                    log.info("Not fetching while pushing")
+                    scheduler.skipped("fetch")
+        if scheduler.due("merge") or fetched:
+            with remote_lock_if_free() as locked:
+                if not locked:
+                    log.info("Not merging while pushing")
+                    scheduler.skipped("merge")
+                else:
+                    with metrics.phase("merge"):
+                        pull_requests = find_pull_requests(args, index)
+                        branches_to_merge = [(full_branch, short_branch) for full_branch, short_branch, tag, new in pull_requests if tag == "merge"]
+                        results = []
+                        if getattr(args, "batch_merge", False):
+                            if branches_to_merge:
+                                results = merge_branches(args, branches_to_merge)
+                        else:
+                            for full_branch, short_branch in branches_to_merge:
+                                results.append((full_branch, merge_branch(args, full_branch, short_branch)))
+                        for full_branch, result in results:
+                            if result == "failed":
+                                # not attempted again until the branch gets a new commit
+                                index.set_branch_tag("refs/remotes/"+full_branch, "merge-failed")
+                    merged = len([result for full_branch, result in results if result == "merged"])
+                    metrics.count("branches_merged", merged)
+                    scheduler.done("merge", merged > 0 or any(new for full_branch, short_branch, tag, new in pull_requests))
+        
+        if getattr(args, "maintenance", False) and (scheduler.force or scheduler.idle()):
+            with remote_lock_if_free() as locked:
+                if locked:
+                    with metrics.phase("maintenance"):
+                        Maintenance(args.archive, index).run()
+        
+        scheduler.save()
+        return scheduler.seconds_until_next()
+    finally:
+        index.close()
+
+
+@contextmanager
+def remote_lock_if_free():
+    """Takes `remote_lock` if it is free, and yields whether it was taken."""
+    locked = remote_lock.acquire(blocking=False)
+    try:
+        yield locked
+    finally:
+        if locked:
+            remote_lock.release()
+
+
+def update_books(args, index):
+    """Commits all changed books. Returns the number of commits made."""
     
     # Iterate books
-    for format_id in os.listdir(args.archive):
-        format_dir = os.path.join(args.archive, format_id)
+    books = None
+    if getattr(args, "watcher", None) is not None:
+        books = args.watcher.changed_books()
+    tracker = getattr(args, "settle_tracker", None)
+    if tracker is not None:
+        # so that a book that was settling when a one-shot run ended is not forgotten by the next run
+        tracker.load(index.get_state("settle_pending", []))
+    full_scan = books is None
+    scan_started = time.time()
+    # books that are not in the index yet are new if they were modified after the previous full scan
+    # started, since they may have been created while it was running, or right after it
+    new_since = index.get_state("full_scan_started", scan_started - 60)
+    if books is None:
+        books = list_books(args.archive)
+    elif tracker is not None:
+        # books that are still settling must be checked again even if nothing happened to them
+        watched = set((format_id, book_id) for format_id, book_id, book_dir in books)
+        books += [(format_id, book_id, os.path.join(args.archive, format_id, book_id)) for format_id, book_id in tracker.pending if (format_id, book_id) not in watched]
+    signatures = index.load_books()
+    manifests = None
+    if getattr(args, "manifest", False):
+        manifests = index.load_manifests(None if full_scan else [(format_id, book_id) for format_id, book_id, book_dir in books])
+    hash_pool = None
+    if manifests is not None and getattr(args, "hash_workers", 1) > 1:
+        hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.hash_workers, thread_name_prefix="hash")
+    updated_signatures = {}
+    updated_manifests = {}
+    pusher = getattr(args, "pusher", None) or PushBatch(args)
+    repository = getattr(args, "repository", None)
+    commits = 0
+    try:
+        if repository is not None:
+            check_call(["git", "reset", "-q"], cwd=args.archive, timeout=60) # make sure nothing else is staged
+        for format_id, book_id, book_dir, signature, manifest in scan_books(books, getattr(args, "workers", 1), manifests, background=getattr(args, "async_push", False), hash_pool=hash_pool):
+            if signature is None:
+                if tracker is not None:
+                    tracker.forget((format_id, book_id))
+                continue
+            log.debug("Processing book: "+format_id+"/"+book_id)
+            metrics.count("books_scanned")
+            previous = signatures.get((format_id, book_id))
+            
+            if manifest is not None and (format_id, book_id) in manifests:
+                changed = not manifests_equal(manifest, manifests[(format_id, book_id)])
+                reason = "Manifest"
+                if not changed and manifest != manifests.get((format_id, book_id)):
+                    # same content, but new inodes or mtimes (for instance after a touch); store them
+                    # so that the files are not hashed again in the next iteration
+                    updated_manifests[(format_id, book_id)] = manifest
+            elif previous is not None and previous.max_mtime is not None:
+                # compared with the signature stored at the last change, so that a change is
+                # never missed however long it has been since the book was last scanned
+                changed = tuple(signature[:3]) != tuple(previous[:3])
+                reason = "Signature"
+            else:
+                # books that have never been seen are only committed if they were modified since the previous full scan
+                recent = signature.max_mtime > min(new_since, time.time() - 60) or (tracker is not None and (format_id, book_id) in tracker.pending)
+                changed = signature.max_mtime > time.time() - 86400 and recent
+                reason = "Last modified timestamp"
+            if manifest is not None and not changed and (format_id, book_id) not in manifests:
+                # the first time a book is scanned with --manifest (for instance when --manifest is turned on
+                # for an existing archive), old uncommitted changes are left alone like without --manifest,
+                # but a book that is not in git at all (for instance copied in with `cp -a`) is committed
+                if book_committed(args, format_id+"/"+book_id):
+                    updated_manifests[(format_id, book_id)] = manifest
+                else:
+                    changed = True
+                    reason = "Untracked book"
+            
+            if changed and tracker is not None:
+                last_activity = args.watcher.activity.get((format_id, book_id)) if getattr(args, "watcher", None) is not None else None
+                if not tracker.settled((format_id, book_id), signature, last_activity):
+                    log.debug("Waiting for "+format_id+"/"+book_id+" to settle")
+                    continue
+            
+            if changed:
+                log.info(reason+" indicates a change in "+format_id+"/"+book_id)
+                metrics.count("books_changed")
+                
+                tree_hash = previous.tree_hash if previous is not None else None
+                commit = None
+                if repository is not None:
+                    commit = repository.commit_path(format_id+"/"+book_id, "Updated book: "+book_id)
+                    if commit is not None:
+                        tree_hash = commit[1]
+                else:
+                    with metrics.phase("stage"):
+                        check_call(["git", "reset", "-q"], cwd=args.archive, timeout=60)
+                        check_call(["git", "add", os.path.relpath(book_dir, args.archive)], cwd=args.archive, timeout=60)
+                        staged = has_staged_changes(args.archive)
+                    if staged:
+                        with metrics.phase("commit"):
+                            check_call(["git", "commit", "-q", "-m", "Updated book: "+book_id], cwd=args.archive, timeout=60)
+                            tree_hash = check_output(["git", "rev-parse", "HEAD:"+format_id+"/"+book_id], cwd=args.archive, universal_newlines=True, timeout=60).strip()
+                        commit = True
+                if commit:
+                    log.info("Committed "+format_id+"/"+book_id)
+                    metrics.count("commits")
+                    commits += 1
+                    pusher.committed()
+                
+                updated_signatures[(format_id, book_id)] = signature._replace(tree_hash=tree_hash)
+                if manifest is not None:
+                    updated_manifests[(format_id, book_id)] = manifest
+        if full_scan:
+            index.set_state("full_scan_started", scan_started)
+    except BaseException:
+        if getattr(args, "watcher", None) is not None:
+            # check the books again in the next iteration instead of waiting for the next full rescan
+            args.watcher.retry(None if full_scan else books)
+        raise
+    finally:
+        index.save_books(updated_signatures)
+        index.save_manifests(updated_manifests)
+        if tracker is not None:
+            index.set_state("settle_pending", tracker.dump())
+        if hash_pool is not None:
+            hash_pool.shutdown()
+        pusher.push()
+    
+    return commits
+
+
+def scan_books(books, workers, manifests=None, background=False, hash_pool=None):
+    """Yields (format_id, book_id, book_dir, signature, manifest) as each book is scanned; signature is None for books that no longer exist."""
+    if workers <= 1 and not background:
+        for book in books:
+            yield scan_book(book, manifests, hash_pool)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(scan_book, book, manifests, hash_pool) for book in books]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def scan_book(book, manifests=None, hash_pool=None):
+    format_id, book_id, book_dir = book
+    manifest = None
+    try:
+        with metrics.phase("scan"):
+            if manifests is None:
+                signature = book_signature(book_dir)
+            else:
+                signature, manifest = book_manifest(book_dir, manifests.get((format_id, book_id), {}), hash_pool)
+    except (FileNotFoundError, NotADirectoryError):
+        signature = None
+    return format_id, book_id, book_dir, signature, manifest
+
+
+def book_committed(args, path):
+    """Checks whether a book directory exists in HEAD."""
+    repository = getattr(args, "repository", None)
+    if repository is not None:
+        return repository.object_id("HEAD:"+path) is not None
+    return call(["git", "rev-parse", "--verify", "-q", "HEAD:"+path], cwd=args.archive, stdout=subprocess.DEVNULL, timeout=60) == 0
+
+
+def has_staged_changes(archive):
+    """Checks whether anything is staged, without reading the diff itself."""
+    return_code = call(["git", "diff", "--staged", "--quiet"], cwd=archive, timeout=60)
+    if return_code not in (0, 1):
+        raise CalledProcessError(return_code, ["git", "diff", "--staged", "--quiet"])
+    return return_code == 1
+
+
+class GitRepository:
+    """The git repository of the archive, read through long-lived `git cat-file` processes."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.processes = {}
+    
+    def close(self):
+        for process in self.processes.values():
+            process.stdin.close()
+            process.wait()
+        self.processes = {}
+    
+    def cat_file(self, option, name):
+        """Sends one request to a `git cat-file` process, restarting it if it has died. Returns the header line."""
+        for attempt in range(2):
+            process = self.processes.get(option)
+            if process is None or process.poll() is not None:
+                process = subprocess.Popen(["git", "cat-file", option], cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                self.processes[option] = process
+                metrics.count("cat_file_processes")
+            try:
+                process.stdin.write(name.encode("utf-8") + b"\n")
+                process.stdin.flush()
+                header = process.stdout.readline().decode("utf-8")
+            except BrokenPipeError:
+                header = ""
+            if header:
+                metrics.count("cat_file_requests")
+                return header.rstrip("\n")
+            del self.processes[option]
+        raise Exception("git cat-file "+option+" stopped responding")
+    
+    def object_id(self, name):
+        """Returns the object id for a revision (for instance `HEAD` or `HEAD:daisy202/BOOK`), or None if it does not exist."""
+        header = self.cat_file("--batch-check", name)
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+        return header.split(" ")[0]
+    
+    def read_object(self, name):
+        """Returns the contents of an object as bytes, or None if it does not exist."""
+        header = self.cat_file("--batch", name)
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+        size = int(header.split(" ")[2])
+        process = self.processes["--batch"]
+        data = process.stdout.read(size)
+        process.stdout.read(1) # trailing newline
+        return data
+    
+    def commit_message(self, commit):
+        data = self.read_object(commit)
+        if data is None:
+            return ""
+        return data.decode("utf-8", errors="replace").split("\n\n", 1)[-1]
+    
+    def commit_path(self, path, message):
+        """Stages and commits everything below `path`. Returns (commit, tree of `path`), or None if nothing changed."""
+        with metrics.phase("stage"):
+            check_call(["git", "add", "-A", "--", path], cwd=self.path, timeout=60)
+        head = self.object_id("HEAD")
+        with metrics.phase("commit"):
+            command = ["git", "commit", "-q", "-m", message]
+            returncode = call(command, cwd=self.path, stdout=subprocess.DEVNULL, timeout=60)
+        commit = self.object_id("HEAD")
+        if commit == head:
+            # `git commit` also fails when there is nothing to commit; only look closer in that case
+            if returncode != 0 and has_staged_changes(self.path):
+                raise CalledProcessError(returncode, command)
+            return None
+        return commit, self.object_id("HEAD:"+path)
+
+
+class PushBatch:
+    """Pushes after `--push-batch-size` commits, after `--push-batch-time` seconds, and at the end of the iteration."""
+    
+    def __init__(self, args):
+        self.archive = args.archive
+        self.batch_size = getattr(args, "push_batch_size", 1)
+        self.batch_time = getattr(args, "push_batch_time", None)
+        self.unpushed = 0
+        self.first_unpushed = None
+    
+    def committed(self):
+        self.unpushed += 1
+        if self.first_unpushed is None:
+            self.first_unpushed = time.time()
+        if ((self.batch_size and self.unpushed >= self.batch_size)
+                or (self.batch_time is not None and time.time() - self.first_unpushed >= self.batch_time)):
+            self.push()
+    
+    def push(self):
+        if not self.unpushed:
+            return
+        log.info("Pushing "+str(self.unpushed)+" commit"+("s" if self.unpushed > 1 else ""))
+        with metrics.phase("push"):
+            check_call(["git", "push", "-q"], cwd=self.archive, timeout=60)
+        metrics.count("pushes")
+        self.unpushed = 0
+        self.first_unpushed = None
+
+
+class BackgroundPusher(threading.Thread):
+    """Like PushBatch, but pushes from a background thread."""
+    
+    def __init__(self, args):
+        super().__init__(name="pusher", daemon=True)
+        self.archive = args.archive
+        self.batch_size = getattr(args, "push_batch_size", 1)
+        self.batch_time = getattr(args, "push_batch_time", None)
+        self.condition = threading.Condition()
+        self.unpushed = 0
+        self.first_unpushed = None
+        self.requested = False
+        self.failures = 0
+        self.retry_at = 0
+        self.start()
+    
+    def committed(self):
+        with self.condition:
+            self.unpushed += 1
+            if self.first_unpushed is None:
+                self.first_unpushed = time.time()
+            if self.batch_size and self.unpushed >= self.batch_size:
+                self.requested = True
+            self.condition.notify_all()
+    
+    def push(self):
+        with self.condition:
+            if self.unpushed:
+                self.requested = True
+                self.condition.notify_all()
+    
+    def flush(self, timeout=None):
+        """Requests a push and waits until all commits have been pushed. Returns False on timeout."""
+        self.push()
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.unpushed, timeout)
+    
+    def next_push_delay(self):
+        """Returns 0 if a push should be done now, otherwise how long to wait (None means until notified)."""
+        now = time.time()
+        if self.unpushed and not self.requested and self.batch_time is not None and now >= self.first_unpushed + self.batch_time:
+            self.requested = True
+        if not self.unpushed or not self.requested:
+            if self.unpushed and self.batch_time is not None:
+                return self.first_unpushed + self.batch_time - now
+            return None
+        return max(0, self.retry_at - now)
+    
+    def run(self):
+        while True:
+            with self.condition:
+                delay = self.next_push_delay()
+                while delay != 0:
+                    self.condition.wait(delay)
+                    delay = self.next_push_delay()
+                count = self.unpushed
+            log.info("Pushing "+str(count)+" commit"+("s" if count > 1 else "")+" in the background")
+            try:
+                with metrics.phase("push"), remote_lock:
+                    check_call(["git", "push", "-q"], cwd=self.archive, timeout=600)
+                metrics.count("pushes")
+            except Exception as e:
+                with self.condition:
+                    self.failures += 1
+                    retry_delay = min(300, 2 ** self.failures)
+                    self.retry_at = time.time() + retry_delay
+                log.warning("Push failed ("+str(e)+"); retrying in "+str(retry_delay)+" seconds")
+                continue
+            with self.condition:
+                self.unpushed -= count
+                if not self.unpushed:
+                    self.requested = False
+                    self.first_unpushed = None
+                self.failures = 0
+                self.retry_at = 0
+                self.condition.notify_all()
+
+
+def find_pull_requests(args, index):
+    """Returns a list of (full_branch, short_branch, tag, new) for remote branches not merged into master."""
+    repository = getattr(args, "repository", None)
+    format = "%(refname)%00%(objectname)%00" + ("" if repository is not None else "%(contents)") + "%00"
+    output = check_output(["git", "for-each-ref", "--no-merged=HEAD", "--format="+format, "refs/remotes/"],
+                          cwd=args.archive, universal_newlines=True, timeout=60)
+    fields = output.split("\0")
+    previous_tips = index.load_branch_tips()
+    tips = {}
+    pull_requests = []
+    for i in range(0, len(fields) - 2, 3):
+        refname, tip, message = fields[i].lstrip("\n"), fields[i + 1], fields[i + 2]
+        if refname.endswith("/HEAD"):
+            continue
+        full_branch = refname[len("refs/remotes/"):]
+        short_branch = re.sub(r".*/", "", full_branch)
+        if refname in previous_tips and previous_tips[refname][0] == tip:
+            tips[refname] = previous_tips[refname]
+            if previous_tips[refname][1] == "merge":
+                pull_requests.append((full_branch, short_branch, "merge", False))
+            continue
+        if repository is not None:
+            message = repository.commit_message(tip)
+        tag = branch_tag(message)
+        log.info(full_branch+" ("+tip[:7]+"): "+(("tagged ["+tag+" archive]") if tag else "not tagged"))
+        tips[refname] = (tip, tag)
+        pull_requests.append((full_branch, short_branch, tag, True))
+    index.save_branch_tips(tips)
+    return pull_requests
+
+
+def branch_tag(commit_message):
+    """Returns the tag in `[archive <tag>]` or `[<tag> archive]` in a commit message, if any."""
+    for line in commit_message.splitlines():
+        if re.match(r".*\[archive [a-z]+\].*", line):
+            return re.sub(r".*\[archive ([a-z]+)\].*", r"\1", line)
+        if re.match(r".*\[[a-z]+ archive\].*", line):
+            return re.sub(r".*\[([a-z]+) archive\].*", r"\1", line)
+    return None
+
+
+def merge_branch(args, full_branch, short_branch):
+    """Merges a branch into master and pushes it. Returns "merged", or "failed" if the merge failed."""
+    print("Will attempt to merge "+full_branch)
+    #call(["git", "branch", "-D", short_branch], cwd=args.archive, timeout=60) # in case remote branch has deviated from local branch with same name
+    check_call(["git", "pull"], cwd=args.archive, timeout=60)
+    try:
+        merge_into_master(args, full_branch)
+    except CalledProcessError as e:
+        print("Failed to merge "+full_branch+": "+str(e))
+        if os.path.exists(os.path.join(args.archive, ".git", "MERGE_HEAD")):
+            call(["git", "merge", "--abort"], cwd=args.archive, timeout=60)
+        return "failed"
+    print("Merge complete")
+    check_call(["git", "push"], cwd=args.archive, timeout=60)
+    check_call(["git", "push", "origin", "--delete", short_branch], cwd=args.archive, timeout=60)
+    call(["git", "branch", "-D", short_branch], cwd=args.archive, timeout=60) # clean up; no need to store other branches locally
+    return "merged"
+
+
+def merge_branches(args, branches):
+    """Merges a list of (full_branch, short_branch) into master with a single pull and push. Returns a list of (full_branch, result)."""
+    print("Will attempt to merge "+str(len(branches))+" branches")
+    check_call(["git", "pull"], cwd=args.archive, timeout=60)
+    results = []
+    merged = []
+    for full_branch, short_branch in branches:
+        try:
+            merge_into_master(args, full_branch)
+            merged.append(short_branch)
+            results.append((full_branch, "merged"))
+        except CalledProcessError as e:
+            print("Failed to merge "+full_branch+": "+str(e))
+            if os.path.exists(os.path.join(args.archive, ".git", "MERGE_HEAD")):
+                call(["git", "merge", "--abort"], cwd=args.archive, timeout=60)
+            results.append((full_branch, "failed"))
+    if merged:
+        check_call(["git", "push"], cwd=args.archive, timeout=60)
+        check_call(["git", "push", "origin", "--delete"] + merged, cwd=args.archive, timeout=60)
+        call(["git", "branch", "-D"] + merged, cwd=args.archive, timeout=60) # clean up; no need to store other branches locally
+    for full_branch, result in results:
+        print(full_branch+": "+result)
+    return results
+
+
+def merge_into_master(args, full_branch):
+    """Merges a branch into the current branch, resolving any conflicts by using the version from the branch."""
+    return_code = call(["git", "merge", full_branch, "--no-ff", "-m", "Merged "+full_branch+" into master"], cwd=args.archive, timeout=60)
+    if return_code:
+        conflict_files = check_output(["git", "--no-pager", "diff", "--name-only", "--diff-filter=U"], cwd=args.archive, universal_newlines=True, timeout=60)
+        conflict_files = conflict_files.splitlines()
+        print("conflict files:")
+        print(conflict_files)
+        for conflict_file in conflict_files:
+            print("Merge conflict in "+conflict_file+"; using the one from "+full_branch)
+            call(["git", "checkout", "--theirs", conflict_file], cwd=args.archive, timeout=60)
+            call(["git", "add", conflict_file], cwd=args.archive, timeout=60)
+        check_call(["git", "commit", "-m", "Merged "+full_branch+" into master"], cwd=args.archive, timeout=60)
+
+
+class SettleTracker:
+    """Holds back commits of books that are still being written to."""
+    
+    def __init__(self, quiet_period, max_settle_time):
+        self.quiet_period = quiet_period
+        self.max_settle_time = max_settle_time
+        self.pending = {}
+    
+    def settled(self, key, signature, last_activity=None):
+        """Records the current signature of a changed book, and returns True if it can be committed."""
+        now = time.time()
+        sizes = list(signature[:3])
+        state = self.pending.get(key)
+        if state is None:
+            state = self.pending[key] = {"first_seen": now, "last_change": min(now, signature.max_mtime), "signature": sizes}
+        elif state["signature"] != sizes:
+            state["last_change"] = now
+            state["signature"] = sizes
+        if last_activity is not None:
+            state["last_change"] = max(state["last_change"], last_activity)
+        if now - state["last_change"] >= self.quiet_period:
+            del self.pending[key]
+            return True
+        if now - state["first_seen"] >= self.max_settle_time:
+            log.warning(key[0]+"/"+key[1]+" has not settled after "+str(self.max_settle_time)+" seconds; committing it anyway")
+            del self.pending[key]
+            return True
+        return False
+    
+    def forget(self, key):
+        self.pending.pop(key, None)
+    
+    def load(self, pending):
+        """Restores books that were still settling when the previous iteration (possibly a previous run) ended."""
+        for format_id, book_id, state in pending:
+            self.pending.setdefault((format_id, book_id), state)
+    
+    def dump(self):
+        """Returns the books that are still settling, in a form that can be stored as JSON."""
+        return [[format_id, book_id, state] for (format_id, book_id), state in sorted(self.pending.items())]
+
+
+class Maintenance:
+    """Maintains the git repository while the archive is idle (see `maintenance_config` in the state table)."""
+    
+    DEFAULT_INTERVALS = {
+        "incremental-repack": 86400,
+        "commit-graph": 3600,
+        "multi-pack-index": 3600,
+        "index-caches": 86400,
+        "prune-branches": 3600,
+    }
+    
+    TIMED_COMMANDS = [
+        ["git", "status", "--porcelain"],
+        ["git", "diff", "--staged", "--quiet"],
+        ["git", "for-each-ref", "--no-merged=HEAD", "refs/remotes/"],
+    ]
+    
+    def __init__(self, archive, index):
+        self.archive = archive
+        self.index = index
+        self.intervals = dict(self.DEFAULT_INTERVALS, **index.get_state("maintenance_config", {}))
+        self.last_run = index.get_state("maintenance", {})
+    
+    def due_tasks(self):
+        now = time.time()
+        return [task for task in self.DEFAULT_INTERVALS if self.last_run.get(task, 0) + self.intervals[task] <= now]
+    
+    def run(self):
+        tasks = self.due_tasks()
+        if not tasks:
+            return
+        print("---------------------------")
+        print("  repository maintenance   ")
+        print("---------------------------")
+        before = self.time_commands()
+        for task in tasks:
+            start = time.monotonic()
+            try:
+                getattr(self, task.replace("-", "_"))()
+            except (CalledProcessError, subprocess.TimeoutExpired) as e:
+                log.warning("Maintenance task "+task+" failed: "+str(e))
+            log.info("Maintenance task "+task+" took %.2f seconds" % (time.monotonic() - start))
+            self.last_run[task] = time.time()
+            self.index.set_state("maintenance", self.last_run)
+        after = self.time_commands()
+        for command in before:
+            log.info(command+": %.3f -> %.3f seconds" % (before[command], after[command]))
+        self.index.set_state("maintenance_timings", {"time": time.time(), "tasks": tasks, "before": before, "after": after})
+    
+    def time_commands(self):
+        timings = {}
+        for command in self.TIMED_COMMANDS:
+            start = time.monotonic()
+            call(command, cwd=self.archive, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=600)
+            timings[" ".join(command)] = time.monotonic() - start
+        return timings
+    
+    def incremental_repack(self):
+        # pack loose objects and combine small packs, without rewriting the large packs every time
+        if call(["git", "repack", "-d", "-q", "--geometric=2", "--write-midx"], cwd=self.archive, timeout=3600) != 0:
+            check_call(["git", "repack", "-d", "-q"], cwd=self.archive, timeout=3600)
+        check_call(["git", "prune-packed", "-q"], cwd=self.archive, timeout=3600)
+    
+    def commit_graph(self):
+        check_call(["git", "commit-graph", "write", "--reachable", "--split"], cwd=self.archive, timeout=3600)
+        check_call(["git", "config", "core.commitGraph", "true"], cwd=self.archive, timeout=60)
+    
+    def multi_pack_index(self):
+        check_call(["git", "multi-pack-index", "write"], cwd=self.archive, timeout=3600)
+    
+    def index_caches(self):
+        check_call(["git", "config", "core.untrackedCache", "true"], cwd=self.archive, timeout=60)
+        check_call(["git", "update-index", "--untracked-cache"], cwd=self.archive, timeout=600)
+        # the builtin fsmonitor is not available on all platforms (for instance Linux)
+        if call(["git", "fsmonitor--daemon", "status"], cwd=self.archive, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60) in (0, 1):
+            check_call(["git", "config", "core.fsmonitor", "true"], cwd=self.archive, timeout=60)
+        else:
+            log.debug("fsmonitor is not supported on this platform")
+    
+    def prune_branches(self):
+        branches = check_output(["git", "for-each-ref", "--merged=master", "--format=%(refname:short)", "refs/heads/"],
+                                cwd=self.archive, universal_newlines=True, timeout=60).split()
+        branches = [branch for branch in branches if branch != "master"]
+        if branches:
+            log.info("Deleting merged local branches: "+", ".join(branches))
+            check_call(["git", "branch", "-q", "-d"] + branches, cwd=self.archive, timeout=60)
+
+
+class Scheduler:
+    """Decides when to scan, fetch and merge (see `scheduler_config` in the state table)."""
+    
+    DEFAULT_CONFIG = {
+        "scan": {"min_interval": 5, "max_interval": 60, "backoff": 2},
+        "fetch": {"min_interval": 60, "max_interval": 900, "backoff": 2},
+        "merge": {"min_interval": 5, "max_interval": 300, "backoff": 2},
+    }
+    
+    def __init__(self, index, force=False):
+        self.index = index
+        self.force = force
+        config = index.get_state("scheduler_config")
+        if config is None:
+            config = self.DEFAULT_CONFIG
+            index.set_state("scheduler_config", config)
+        self.config = {task: dict(self.DEFAULT_CONFIG[task], **config.get(task, {})) for task in self.DEFAULT_CONFIG}
+        self.state = index.get_state("scheduler", {})
+    
+    def due(self, task):
+        return self.force or task not in self.state or self.state[task]["next_run"] <= time.time()
+    
+    def done(self, task, active):
+        config = self.config[task]
+        interval = self.state.get(task, {}).get("interval", config["min_interval"])
+        if active:
+            interval = config["min_interval"]
+        else:
+            interval = interval * config["backoff"]
+        interval = max(config["min_interval"], min(config["max_interval"], interval))
+        now = time.time()
+        self.state[task] = {
+            "interval": interval,
+            "last_run": now,
+            "next_run": now + interval,
+            "last_active": now if active else self.state.get(task, {}).get("last_active"),
+        }
+        log.debug("Next "+task+" in "+str(round(interval))+" seconds"+(" (activity detected)" if active else ""))
+    
+    def skipped(self, task):
+        """Tries a task that could not run now (for instance while pushing) again after its minimum interval, without changing its interval."""
+        state = self.state.setdefault(task, {"interval": self.config[task]["min_interval"], "last_run": None, "last_active": None})
+        state["next_run"] = time.time() + self.config[task]["min_interval"]
+    
+    def idle(self):
+        """Returns True if none of the tasks have had any activity during the last `idle_time` seconds."""
+        idle_time = self.index.get_state("scheduler_idle_time", 300)
+        last_active = [self.state[task]["last_active"] for task in self.state if self.state[task].get("last_active")]
+        return not last_active or max(last_active) < time.time() - idle_time
+    
+    def seconds_until_next(self):
+        next_runs = [self.state[task]["next_run"] for task in self.state]
+        if len(next_runs) < len(self.config):
+            return 1
+        return max(1, min(next_runs) - time.time())
+    
+    def save(self):
+        self.index.set_state("scheduler", self.state)
+
+
+def list_books(archive):
+    """Yields (format_id, book_id, book_dir) for all books in the archive."""
+    for format_id in sorted(os.listdir(archive)):
+        format_dir = os.path.join(archive, format_id)
         if format_id.startswith(".") or format_id.startswith("_") or not os.path.isdir(format_dir):
             continue
-        print("format_dir: "+format_dir)
-        for book_id in os.listdir(format_dir):
+        for book_id in sorted(os.listdir(format_dir)):
             book_dir = os.path.join(format_dir, book_id)
-            print("book_dir: "+book_dir)
             if (os.path.isdir(book_dir) and not book_id.startswith(".") and not book_id.startswith("_")):
-                print("Processing book: "+book_id)
-                db_filename = os.path.join(db_dir, format_id+"_"+book_id+".json")
-                db = load_data(db_filename)
-                
-                last_modified = None
-                for root, dirs, files in os.walk(book_dir):
-                    for name in files:
-                        modified = modification_date(os.path.join(root, name))
-                        if (last_modified == None or modified > last_modified):
-                            last_modified = modified
-                            print(book_id+": "+name+" is modified...")
-                    for name in dirs:
-                        modified = modification_date(os.path.join(root, name))
-                        if (last_modified == None or modified > last_modified):
-                            last_modified = modified
-                
-                previous_modified = None
-                if ("last_modified" in db):
-                    previous_modified = parser.parse(db["last_modified"])
+                yield format_id, book_id, book_dir
+
+
+class ArchiveWatcher:
+    """Keeps track of the books that have changed, using inotify."""
+    
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, archive, full_rescan_interval):
+        self.archive = archive
+        self.full_rescan_interval = full_rescan_interval
+        self.dirty = set()
+        self.activity = {}
+        self.needs_full_scan = True
+        self.last_full_scan = None
+        self.watches = {}
+        self.fd = None
+        self.libc = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0:
+            log.warning("inotify is not available; falling back to polling the entire archive")
+            return
+        self.fd = fd
+        if not self.watch_tree(self.archive):
+            self.close()
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
+            log.warning("stopped watching the archive; falling back to polling the entire archive")
+    
+    def watch_tree(self, path):
+        """Watch a directory and all its subdirectories. Returns False if inotify gives up."""
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not (root == self.archive and (d.startswith(".") or d.startswith("_")))]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    log.warning("inotify watch limit reached (see /proc/sys/fs/inotify/max_user_watches)")
+                    return False
+                if error != errno.ENOENT:
+                    log.warning("unable to watch "+root+": "+os.strerror(error), extra={"rate_limit": True})
+                continue
+            self.watches[wd] = root
+        return True
+    
+    def mark_dirty(self, path):
+        relpath = os.path.relpath(path, self.archive)
+        parts = relpath.split(os.sep)
+        if relpath == "." or parts[0].startswith(".") or parts[0].startswith("_"):
+            return
+        if len(parts) == 1:
+            # a whole format directory was created or moved into place
+            format_dir = os.path.join(self.archive, parts[0])
+            if os.path.isdir(format_dir):
+                for book_id in os.listdir(format_dir):
+                    self.mark_dirty(os.path.join(format_dir, book_id))
+            return
+        if parts[1].startswith(".") or parts[1].startswith("_"):
+            return
+        self.dirty.add((parts[0], parts[1]))
+        self.activity[(parts[0], parts[1])] = time.time()
+    
+    def read_events(self):
+        while self.fd is not None:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    log.warning("inotify event queue overflowed; will check all books")
+                    self.needs_full_scan = True
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                self.mark_dirty(path)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    if not self.watch_tree(path):
+                        self.close()
+                        return
+                    self.mark_dirty(path)
+    
+    def retry(self, books):
+        """Makes `changed_books` return the given (format_id, book_id, book_dir) again, or all books if books is None."""
+        if books is None:
+            self.needs_full_scan = True
+        else:
+            self.dirty.update((format_id, book_id) for format_id, book_id, book_dir in books)
+    
+    def has_changes(self):
+        """Returns True if any book has changed since the last call to `changed_books`."""
+        self.read_events()
+        return self.fd is not None and (bool(self.dirty) or self.needs_full_scan)
+    
+    def wait(self, timeout):
+        """Sleeps for `timeout` seconds, or until something changes in the archive."""
+        if self.fd is None or self.has_changes():
+            time.sleep(timeout if self.fd is None else 0)
+            return
+        select.select([self.fd], [], [], timeout)
+        time.sleep(1) # let the change settle a bit, and avoid busy looping on events from the same operation
+    
+    def changed_books(self):
+        """Returns (format_id, book_id, book_dir) for the books that have changed since the last call, or None to check all books."""
+        self.read_events()
+        now = time.time()
+        self.activity = {key: last_activity for key, last_activity in self.activity.items() if last_activity > now - 3600}
+        if (self.fd is None or self.needs_full_scan
+                or self.last_full_scan is None or self.last_full_scan < now - self.full_rescan_interval):
+            self.needs_full_scan = False
+            self.last_full_scan = now
+            self.dirty = set()
+            return None
+        books = [(format_id, book_id, os.path.join(self.archive, format_id, book_id)) for format_id, book_id in sorted(self.dirty)]
+        self.dirty = set()
+        return books
+
+
+BookSignature = namedtuple("BookSignature", ["max_mtime", "file_count", "total_size", "tree_hash"])
+
+
+def book_signature(book_dir):
+    """Returns the newest mtime, the number of files and the total size of a book directory."""
+    max_mtime = os.stat(book_dir).st_mtime
+    file_count = 0
+    total_size = 0
+    directories = [book_dir]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > max_mtime:
+                    max_mtime = stat.st_mtime
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
                 else:
-                    previous_modified = datetime.utcnow() - timedelta(days=1)
-                
-                if (last_modified > previous_modified and last_modified > datetime.utcnow() - timedelta(seconds=60)):
-                    # the last modified timestamp for the book has changed
-                    print("Last modified timestamp indicates a change in "+book_id)
-                    
-                    db["last_modified"] = str(last_modified)
-                    db["id"] = book_id
-                    save_data(db_filename, db)
-                    
-                    check_call(["git", "reset"], cwd=args.archive, timeout=60)
-                    check_call(["git", "add", os.path.relpath(book_dir, args.archive)], cwd=args.archive, timeout=60)
-                    diff = check_output(["git", "--no-pager", "diff", "--staged"], cwd=args.archive, universal_newlines=True, timeout=60)
-                    if diff:
-                        check_call(["git", "commit", "-m", "Updated book: "+book_id], cwd=args.archive, timeout=60)
-                        check_call(["git", "push"], cwd=args.archive, timeout=60)
-                
+                    file_count += 1
+                    total_size += stat.st_size
+    return BookSignature(max_mtime, file_count, total_size, None)
+
+
+ManifestEntry = namedtuple("ManifestEntry", ["size", "inode", "mtime_ns", "hash"])
+
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def book_manifest(book_dir, previous, hash_pool=None):
+    """Returns the signature and the manifest (ManifestEntry keyed on relative path) of a book directory."""
+    max_mtime = os.stat(book_dir).st_mtime
+    total_size = 0
+    manifest = {}
+    unhashed = []
+    directories = [book_dir]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            if directory == book_dir:
+                raise
+            log.warning("unable to read "+directory+": "+str(e), extra={"rate_limit": True})
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue # deleted while scanning
+                if stat.st_mtime > max_mtime:
+                    max_mtime = stat.st_mtime
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                path = os.path.relpath(entry.path, book_dir)
+                total_size += stat.st_size
+                entry_previous = previous.get(path)
+                if (entry_previous is not None and entry_previous.size == stat.st_size
+                        and entry_previous.inode == stat.st_ino and entry_previous.mtime_ns == stat.st_mtime_ns):
+                    manifest[path] = entry_previous
+                elif entry.is_symlink():
+                    # like git, store the link target instead of following the link
+                    digest = symlink_hash(entry.path)
+                    if digest is not None:
+                        manifest[path] = ManifestEntry(stat.st_size, stat.st_ino, stat.st_mtime_ns, digest)
+                    elif entry_previous is not None:
+                        manifest[path] = entry_previous
+                else:
+                    unhashed.append((path, entry.path, stat))
+    if hash_pool is not None and len(unhashed) > 1:
+        hashes = hash_pool.map(file_hash, [filepath for path, filepath, stat in unhashed], [stat.st_size for path, filepath, stat in unhashed])
+    else:
+        hashes = [file_hash(filepath, stat.st_size) for path, filepath, stat in unhashed]
+    for (path, filepath, stat), digest in zip(unhashed, hashes):
+        if digest is not None:
+            manifest[path] = ManifestEntry(stat.st_size, stat.st_ino, stat.st_mtime_ns, digest)
+        elif path in previous:
+            manifest[path] = previous[path]
+    metrics.count("files_hashed", len(unhashed))
+    return BookSignature(max_mtime, len(manifest), total_size, None), manifest
+
+
+def file_hash(path, size):
+    """Content hash of a file, or None if it can not be read."""
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, "rb") as f:
+            if size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    digest.update(data)
+            else:
+                digest.update(f.read())
+    except OSError as e:
+        log.warning("unable to read "+path+": "+str(e), extra={"rate_limit": True})
+        return None
+    return digest.hexdigest()
+
+
+def symlink_hash(path):
+    """Hash of the target of a symbolic link (which is what git stores). Returns None if the link can not be read."""
+    digest = hashlib.blake2b(digest_size=20, person=b"symlink")
+    try:
+        digest.update(os.fsencode(os.readlink(path)))
+    except OSError as e:
+        log.warning("unable to read "+path+": "+str(e), extra={"rate_limit": True})
+        return None
+    return digest.hexdigest()
+
+
+def manifests_equal(manifest, previous):
+    """Compares the paths, sizes and hashes of two manifests, ignoring inodes and mtimes."""
+    if previous is None or len(manifest) != len(previous):
+        return False
+    for path, entry in manifest.items():
+        entry_previous = previous.get(path)
+        if entry_previous is None or entry_previous.size != entry.size or entry_previous.hash != entry.hash:
+            return False
+    return True
+
+
+class ArchiveIndex:
+    """SQLite database in the .db folder of the archive."""
     
-    print("---------------------------")
-    print("  check for pull requests  ")
-    print("---------------------------")
-    if should_git_fetch:
-        check_call(["git", "fetch"], cwd=args.archive, timeout=3600)
-    unmerged_branches = check_output(["git", "branch", "--no-merged=HEAD", "--remote", "--no-color"], cwd=args.archive, universal_newlines=True, timeout=60)
-    unmerged_branches = unmerged_branches.splitlines()
-    for branch in unmerged_branches:
-        full_branch = re.sub(r"^.*?([^ ]+)$", r"\1", branch)
-        short_branch = re.sub(r".*/", "", full_branch)
-        print(branch)
-        commit_message = check_output(["git", "--no-pager", "log", full_branch+"~1.."+full_branch, "--"], cwd=args.archive, universal_newlines=True, timeout=60)
-        commit_message = commit_message.splitlines()
-        tag = None
-        for line in commit_message:
-            if re.match(r".*\[archive [a-z]+\].*", line):
-                tag = re.sub(r".*\[archive ([a-z]+)\].*", r"\1", line)
-                break
-            if re.match(r".*\[[a-z]+ archive\].*", line):
-                tag = re.sub(r".*\[([a-z]+) archive\].*", r"\1", line)
-                break
-        if tag == "merge":
-            print("Will attempt to merge "+full_branch)
-            #call(["git", "branch", "-D", short_branch], cwd=args.archive, timeout=60) # in case remote branch has deviated from local branch with same name
-            check_call(["git", "pull"], cwd=args.archive, timeout=60)
-            return_code = call(["git", "merge", full_branch, "--no-ff", "-m", "Merged "+full_branch+" into master"], cwd=args.archive, timeout=60)
-            if return_code:
-                conflict_files = check_output(["git", "--no-pager", "diff", "--name-only", "--diff-filter=U"], cwd=args.archive, universal_newlines=True, timeout=60)
-                conflict_files = conflict_files.splitlines()
-                print("conflict files:")
-                print(conflict_files)
-                for conflict_file in conflict_files:
-                    print("Merge conflict in "+conflict_file+"; using the one from "+full_branch)
-                    call(["git", "checkout", "--theirs", conflict_file], cwd=args.archive, timeout=60)
-                    call(["git", "add", conflict_file], cwd=args.archive, timeout=60)
-                check_call(["git", "commit", "-m", "Merged "+full_branch+" into master"], cwd=args.archive, timeout=60)
-            print("Merge complete")
-            check_call(["git", "push"], cwd=args.archive, timeout=60)
-            check_call(["git", "push", "origin", "--delete", short_branch], cwd=args.archive, timeout=60)
-            call(["git", "branch", "-D", short_branch], cwd=args.archive, timeout=60) # clean up; no need to store other branches locally
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.connection = sqlite3.connect(os.path.join(db_dir, "index.sqlite"), timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS books ("
+                                    "format_id TEXT NOT NULL, book_id TEXT NOT NULL, "
+                                    "max_mtime REAL, file_count INTEGER, total_size INTEGER, tree_hash TEXT, "
+                                    "PRIMARY KEY (format_id, book_id))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS manifest ("
+                                    "format_id TEXT NOT NULL, book_id TEXT NOT NULL, path TEXT NOT NULL, "
+                                    "size INTEGER, inode INTEGER, mtime_ns INTEGER, hash TEXT, "
+                                    "PRIMARY KEY (format_id, book_id, path))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS branch_tips (refname TEXT PRIMARY KEY, tip TEXT NOT NULL, tag TEXT)")
+        if self.get_state("json_migrated") is None:
+            self.migrate_json()
+    
+    def close(self):
+        self.connection.close()
+    
+    def load_books(self):
+        """Returns a dict of BookSignature for all books, keyed on (format_id, book_id)."""
+        rows = self.connection.execute("SELECT format_id, book_id, max_mtime, file_count, total_size, tree_hash FROM books")
+        return {(row[0], row[1]): BookSignature(*row[2:]) for row in rows}
+    
+    def save_books(self, signatures):
+        """Stores a dict of BookSignature keyed on (format_id, book_id), in a single transaction."""
+        if not signatures:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)",
+                                        [key + tuple(signature) for key, signature in signatures.items()])
+    
+    def load_manifests(self, books=None):
+        """Returns the manifests of the given (format_id, book_id), or of all books."""
+        manifests = {}
+        if books is None:
+            rows = self.connection.execute("SELECT format_id, book_id, path, size, inode, mtime_ns, hash FROM manifest")
+        else:
+            rows = (row for format_id, book_id in set(books)
+                    for row in self.connection.execute("SELECT format_id, book_id, path, size, inode, mtime_ns, hash FROM manifest "
+                                                       "WHERE format_id = ? AND book_id = ?", (format_id, book_id)))
+        for row in rows:
+            manifests.setdefault((row[0], row[1]), {})[row[2]] = ManifestEntry(*row[3:])
+        return manifests
+    
+    def save_manifests(self, manifests):
+        """Replaces the manifests of the given books, in a single transaction."""
+        if not manifests:
+            return
+        with self.connection:
+            self.connection.executemany("DELETE FROM manifest WHERE format_id = ? AND book_id = ?", list(manifests.keys()))
+            self.connection.executemany("INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [key + (path,) + tuple(entry) for key, manifest in manifests.items() for path, entry in manifest.items()])
+    
+    def load_branch_tips(self):
+        """Returns a dict of (tip, tag) for the remote branches classified so far, keyed on refname."""
+        rows = self.connection.execute("SELECT refname, tip, tag FROM branch_tips")
+        return {row[0]: (row[1], row[2]) for row in rows}
+    
+    def save_branch_tips(self, tips):
+        """Replaces the stored branch tips with a dict of (tip, tag) keyed on refname."""
+        with self.connection:
+            self.connection.execute("DELETE FROM branch_tips")
+            self.connection.executemany("INSERT INTO branch_tips VALUES (?, ?, ?)",
+                                        [(refname, tip, tag) for refname, (tip, tag) in tips.items()])
+    
+    def set_branch_tag(self, refname, tag):
+        with self.connection:
+            self.connection.execute("UPDATE branch_tips SET tag = ? WHERE refname = ?", (tag, refname))
+    
+    def get_state(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+    
+    def set_state(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value)))
+    
+    def migrate_json(self):
+        """Imports and removes the JSON files previously used to store state in the .db folder."""
+        archive = os.path.dirname(os.path.abspath(self.db_dir))
+        json_files = [name for name in os.listdir(self.db_dir) if name.endswith(".json")]
+        signatures = {}
+        for name in json_files:
+            data = load_data(os.path.join(self.db_dir, name))
+            if "id" in data and "last_modified" in data and name.endswith("_"+data["id"]+".json"):
+                format_id = name[:-len("_"+data["id"]+".json")]
+                last_modified = utc_timestamp(parser.parse(data["last_modified"]))
+                try:
+                    signature = book_signature(os.path.join(archive, format_id, data["id"]))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                if signature.max_mtime > last_modified:
+                    signature = BookSignature(None, None, None, None)
+                signatures[(format_id, data["id"])] = signature
+        if json_files:
+            print("Migrating "+str(len(json_files))+" JSON files to "+os.path.join(self.db_dir, "index.sqlite"))
+        self.save_books(signatures)
+        self.set_state("json_migrated", True)
+        for name in json_files:
+            os.remove(os.path.join(self.db_dir, name))
+
+
+def call(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.call(command, **kwargs)
+
+
+def check_call(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.check_call(command, **kwargs)
+
+
+def check_output(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.check_output(command, **kwargs)
+
+
+metrics = Metrics("git_book_archive")
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits DEBUG records, and records logged with `extra={"rate_limit": True}`, to `burst` per line of code every `period` seconds."""
+    
+    def __init__(self, burst=20, period=60):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.windows = {}
+    
+    def filter(self, record):
+        if record.levelno > logging.DEBUG and not getattr(record, "rate_limit", False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        window_start, emitted, suppressed = self.windows.get(key, (now, 0, 0))
+        if now - window_start >= self.period:
+            if suppressed:
+                record.msg = str(record.msg) + " (" + str(suppressed) + " similar messages suppressed)"
+            window_start, emitted, suppressed = now, 0, 0
+        if emitted >= self.burst:
+            self.windows[key] = (window_start, emitted, suppressed + 1)
+            return False
+        self.windows[key] = (window_start, emitted + 1, suppressed)
+        return True
+
+
+def configure_logging(level, stream=sys.stdout):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    handler.addFilter(RateLimitFilter())
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+OFFLOAD_FILTER = "archive-offload"
+OFFLOAD_POINTER_HEADER = b"git-book-archive-offload v1\n"
+
+
+def offload_filter(args):
+    """Long-running git filter process (see gitattributes(5)) that offloads large files to the store."""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    if pkt_read_list(stdin) != ["git-filter-client", "version=2"]:
+        raise Exception("Unexpected filter protocol handshake")
+    pkt_write_list(stdout, ["git-filter-server", "version=2"])
+    capabilities = pkt_read_list(stdin)
+    pkt_write_list(stdout, [capability for capability in ["capability=clean", "capability=smudge"] if capability in capabilities])
+    
+    while True:
+        request = pkt_read_list(stdin)
+        if request is None:
+            return
+        request = dict(line.split("=", 1) for line in request)
+        with tempfile.SpooledTemporaryFile(max_size=OFFLOAD_SPOOL_SIZE, dir=args.store) as content:
+            digest = hashlib.sha256()
+            size = 0
+            for data in pkt_read_content(stdin):
+                digest.update(data)
+                size += len(data)
+                content.write(data)
+            content.seek(0)
+            if request["command"] == "clean":
+                result = offload_clean(args, request["pathname"], content, size, digest.hexdigest())
+            elif request["command"] == "smudge":
+                result = offload_smudge(args, request["pathname"], content, size)
+            else:
+                pkt_write_list(stdout, ["status=error"])
+                continue
+            pkt_write_list(stdout, ["status=success"])
+            for data in iter(lambda: result.read(OFFLOAD_PKT_SIZE), b""):
+                pkt_write(stdout, data)
+            pkt_flush(stdout)
+            pkt_flush(stdout) # keep status
+            result.close()
+
+
+def offload_clean(args, pathname, content, size, sha256):
+    if size < args.threshold and not any(fnmatch.fnmatch(pathname, pattern) for pattern in args.pattern):
+        return content
+    store_filepath = offload_store_path(args.store, sha256)
+    if not os.path.exists(store_filepath):
+        os.makedirs(os.path.dirname(store_filepath), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(store_filepath), delete=False) as f:
+            shutil.copyfileobj(content, f)
+        os.replace(f.name, store_filepath)
+    return io.BytesIO(OFFLOAD_POINTER_HEADER + ("sha256 %s\nsize %d\n" % (sha256, size)).encode("utf-8"))
+
+
+def offload_smudge(args, pathname, content, size):
+    if size > 1024:
+        return content
+    pointer = content.read()
+    content.seek(0)
+    if not pointer.startswith(OFFLOAD_POINTER_HEADER):
+        return content
+    fields = dict(line.split(" ", 1) for line in pointer[len(OFFLOAD_POINTER_HEADER):].decode("utf-8").splitlines())
+    store_filepath = offload_store_path(args.store, fields["sha256"])
+    if not os.path.exists(store_filepath):
+        log.warning(pathname+" is missing from the offload store ("+store_filepath+"); checking out the pointer file instead", extra={"rate_limit": True})
+        return content
+    return open(store_filepath, "rb")
+
+
+def offload_store_path(store, sha256):
+    return os.path.join(store, sha256[:2], sha256[2:])
+
+
+OFFLOAD_PKT_SIZE = 65516
+OFFLOAD_SPOOL_SIZE = 1024 * 1024
+
+
+def pkt_read(stream):
+    """Reads one pkt-line. Returns None for a flush packet."""
+    length = stream.read(4)
+    if len(length) < 4:
+        raise EOFError()
+    length = int(length, 16)
+    if length == 0:
+        return None
+    return stream.read(length - 4)
+
+
+def pkt_read_list(stream):
+    """Reads text pkt-lines until a flush packet. Returns None if git has closed the stream."""
+    lines = []
+    try:
+        while True:
+            data = pkt_read(stream)
+            if data is None:
+                return lines
+            lines.append(data.decode("utf-8").rstrip("\n"))
+    except EOFError:
+        if lines:
+            raise
+        return None
+
+
+def pkt_read_content(stream):
+    while True:
+        data = pkt_read(stream)
+        if data is None:
+            return
+        yield data
+
+
+def pkt_write(stream, data):
+    stream.write(("%04x" % (len(data) + 4)).encode("ascii") + data)
+
+
+def pkt_flush(stream):
+    stream.write(b"0000")
+    stream.flush()
+
+
+def pkt_write_list(stream, lines):
+    for line in lines:
+        pkt_write(stream, (line + "\n").encode("utf-8"))
+    pkt_flush(stream)
 
 
 def load_data(db_filename):
@@ -258,9 +1656,8 @@ def save_data(db_filename, data):
         json.dump(data, json_file)
 
 
-def modification_date(filename):
-    t = os.path.getmtime(filename)
-    return datetime.utcfromtimestamp(t)
+def utc_timestamp(utc_datetime):
+    return (utc_datetime - datetime(1970, 1, 1)).total_seconds()
 
 
 def normalize_args(args):
@@ -327,6 +1724,176 @@ def run_tests_iteration():
     run_tests_append_html(os.path.join(args.archive, "epub3", "TEST_BOOK_002", "EPUB", "TEST_BOOK_002-02-chapter.xhtml"))
     
     update(args)
+    
+    run_tests_watcher()
+    run_tests_migration()
+    run_tests_batch_merge()
+    run_tests_manifest()
+    run_tests_offload()
+    print("All tests passed")
+
+
+def run_tests_watcher():
+    print("---------------------------")
+    print("  watch for changes        ")
+    print("---------------------------")
+    args = run_tests_archive("watcher")
+    watcher = ArchiveWatcher(args.archive, args.full_rescan_interval)
+    if watcher.fd is None:
+        print("inotify is not available; not testing the watcher")
+    else:
+        assert watcher.changed_books() is None, "All books should be checked the first time"
+        run_tests_append_html(os.path.join(args.archive, "epub3", "TEST_BOOK_002", "EPUB", "TEST_BOOK_002-02-chapter.xhtml"))
+        os.mkdir(os.path.join(args.archive, ".db"))
+        changed = watcher.changed_books()
+        assert changed == [("epub3", "TEST_BOOK_002", os.path.join(args.archive, "epub3", "TEST_BOOK_002"))], "Only TEST_BOOK_002 has changed: " + str(changed)
+        watcher.retry(changed)
+        changed = watcher.changed_books()
+        assert changed == [("epub3", "TEST_BOOK_002", os.path.join(args.archive, "epub3", "TEST_BOOK_002"))], "Books that failed should be returned again: " + str(changed)
+        changed = watcher.changed_books()
+        assert changed == [], "Nothing has changed since the last call: " + str(changed)
+        shutil.copytree(os.path.join(args.archive, "daisy202", "TEST_BOOK_001"), os.path.join(args.archive, "daisy202", "TEST_BOOK_003"))
+        changed = watcher.changed_books()
+        assert changed == [("daisy202", "TEST_BOOK_003", os.path.join(args.archive, "daisy202", "TEST_BOOK_003"))], "Only TEST_BOOK_003 is new: " + str(changed)
+        watcher.close()
+    shutil.rmtree(os.path.dirname(args.archive))
+
+
+def run_tests_migration():
+    print("---------------------------")
+    print("  migrate the JSON files   ")
+    print("---------------------------")
+    args = run_tests_archive("migration")
+    # an uncommitted change that the JSON files of the previous version of this script have already seen
+    run_tests_append_html(os.path.join(args.archive, "daisy202", "TEST_BOOK_001", "content.html"))
+    db_dir = os.path.join(args.archive, ".db")
+    os.mkdir(db_dir)
+    last_modified = str(datetime.utcnow())
+    for format_id, book_id in [("daisy202", "TEST_BOOK_001"), ("epub3", "TEST_BOOK_002")]:
+        save_data(os.path.join(db_dir, format_id+"_"+book_id+".json"), {"id": book_id, "last_modified": last_modified})
+    update(args)
+    assert metrics.counters.get("books_changed", 0) == 0, "No book has changed since the JSON files were written: " + str(metrics.counters)
+    assert not [name for name in os.listdir(db_dir) if name.endswith(".json")], "The JSON files should be removed"
+    status = check_output(["git", "status", "--porcelain"], cwd=args.archive, universal_newlines=True, timeout=60)
+    assert "daisy202/TEST_BOOK_001/content.html" in status, "The change in TEST_BOOK_001 should still be uncommitted"
+    shutil.rmtree(os.path.dirname(args.archive))
+
+
+def run_tests_batch_merge():
+    print("---------------------------")
+    print("  merge tagged branches    ")
+    print("---------------------------")
+    args = run_tests_archive("batch-merge")
+    args.batch_merge = True
+    source = os.path.join(os.path.dirname(args.archive), "source")
+    check_call(["git", "pull", "-q"], cwd=source, timeout=60)
+    tips = []
+    for branch, message, filepath in [("test-branch-1", "[archive merge] change in branch #1", os.path.join("daisy202", "TEST_BOOK_001", "content.html")),
+                                      ("test-branch-2", "[merge archive] change in branch #2", os.path.join("epub3", "TEST_BOOK_002", "EPUB", "TEST_BOOK_002-02-chapter.xhtml")),
+                                      ("test-not-tagged", "change in branch without tag", os.path.join("daisy202", "TEST_BOOK_001", "ncc.html"))]:
+        check_call(["git", "checkout", "-q", "-b", branch, "master"], cwd=source, timeout=60)
+        run_tests_append_html(os.path.join(source, filepath))
+        check_call(["git", "commit", "-q", "-a", "-m", message], cwd=source, timeout=60)
+        check_call(["git", "push", "-q", "--set-upstream", "origin", branch], cwd=source, timeout=60)
+        tips.append(check_output(["git", "rev-parse", "HEAD"], cwd=source, universal_newlines=True, timeout=60).strip())
+    update(args)
+    assert metrics.counters.get("branches_merged") == 2, "The two tagged branches should be merged: " + str(metrics.counters)
+    assert metrics.subprocesses["git push"]["count"] == 2, "Master should be pushed and the branches deleted with one push each: " + str(metrics.subprocesses)
+    for tip in tips[:2]:
+        assert call(["git", "merge-base", "--is-ancestor", tip, "origin/master"], cwd=args.archive, timeout=60) == 0, tip + " should be merged into master"
+    branches = check_output(["git", "ls-remote", "--heads", "origin"], cwd=args.archive, universal_newlines=True, timeout=60).split()[1::2]
+    assert branches == ["refs/heads/master", "refs/heads/test-not-tagged"], "Only the merged branches should be deleted: " + str(branches)
+    shutil.rmtree(os.path.dirname(args.archive))
+
+
+def run_tests_manifest():
+    print("---------------------------")
+    print("  detect changes by content")
+    print("---------------------------")
+    args = run_tests_archive("manifest")
+    args.manifest = True
+    book_dir = os.path.join(args.archive, "daisy202", "TEST_BOOK_001")
+    # an uncommitted change from three days ago, which should be left alone when --manifest is turned on
+    old_book_dir = os.path.join(args.archive, "epub3", "TEST_BOOK_002")
+    run_tests_append_html(os.path.join(old_book_dir, "EPUB", "TEST_BOOK_002-02-chapter.xhtml"))
+    run_tests_set_mtime(old_book_dir, time.time() - 3 * 86400)
+    update(args)
+    assert metrics.counters.get("commits", 0) == 0, "Nothing should be committed when --manifest is turned on: " + str(metrics.counters)
+    
+    run_tests_set_mtime(book_dir, time.time())
+    update(args)
+    assert metrics.counters.get("books_changed", 0) == 0, "Touching the files of a book is not a change: " + str(metrics.counters)
+    
+    # a new book copied in with its modification times (like `cp -a`) from five days ago
+    new_book_dir = os.path.join(args.archive, "daisy202", "TEST_BOOK_003")
+    shutil.copytree(book_dir, new_book_dir)
+    run_tests_set_mtime(new_book_dir, time.time() - 5 * 86400)
+    update(args)
+    assert metrics.counters.get("commits", 0) == 1, "The new book should be committed: " + str(metrics.counters)
+    
+    os.symlink(old_book_dir, os.path.join(book_dir, "link"))
+    os.symlink("missing", os.path.join(book_dir, "dangling"))
+    update(args)
+    assert metrics.counters.get("commits", 0) == 1, "The symbolic links in TEST_BOOK_001 should be committed: " + str(metrics.counters)
+    status = check_output(["git", "status", "--porcelain"], cwd=args.archive, universal_newlines=True, timeout=60)
+    assert "daisy202/" not in status and "epub3/TEST_BOOK_002/EPUB/TEST_BOOK_002-02-chapter.xhtml" in status, "Only the old change should be uncommitted: " + status
+    shutil.rmtree(os.path.dirname(args.archive))
+
+
+def run_tests_offload():
+    print("---------------------------")
+    print("  offload large media      ")
+    print("---------------------------")
+    args = run_tests_archive("offload")
+    directory = os.path.dirname(args.archive)
+    args.offload_store = os.path.join(directory, "store")
+    args.offload_pattern = ["*.wav"]
+    book_dir = os.path.join(args.archive, "daisy202", "TEST_BOOK_003")
+    shutil.copytree(os.path.join(os.path.dirname(os.path.realpath(__file__)), "test", "daisy202", "TEST_BOOK_001"), book_dir, copy_function=shutil.copy)
+    update(args)
+    with open(os.path.join(book_dir, "audio.wav"), "rb") as f:
+        audio = f.read()
+    pointer = check_output(["git", "cat-file", "blob", "HEAD:daisy202/TEST_BOOK_003/audio.wav"], cwd=args.archive, timeout=60)
+    assert pointer.startswith(OFFLOAD_POINTER_HEADER), "A pointer file should be committed instead of audio.wav"
+    assert os.path.isfile(offload_store_path(args.offload_store, hashlib.sha256(audio).hexdigest())), "audio.wav should be in the offload store"
+    with open(os.path.join(book_dir, "content.html"), "rb") as f:
+        content = f.read()
+    assert check_output(["git", "cat-file", "blob", "HEAD:daisy202/TEST_BOOK_003/content.html"], cwd=args.archive, timeout=60) == content, "content.html should be committed as it is"
+    
+    clone_args = default_update_args(os.path.join(directory, "clone"), args.git_url)
+    clone_args.offload_store = args.offload_store
+    clone_args.offload_pattern = args.offload_pattern
+    git_init(clone_args)
+    with open(os.path.join(clone_args.archive, "daisy202", "TEST_BOOK_003", "audio.wav"), "rb") as f:
+        assert f.read() == audio, "git-init should restore audio.wav from the offload store"
+    shutil.rmtree(directory)
+
+
+def run_tests_archive(name):
+    """Creates a remote with the test books, a clone of it (source) and an archive, in a new temporary directory."""
+    directory = tempfile.mkdtemp(prefix="archive-test-"+name+"-")
+    remote = os.path.join(directory, "remote")
+    source = os.path.join(directory, "source")
+    os.mkdir(remote)
+    check_call(["git", "init", "-q", "--bare"], cwd=remote, timeout=60)
+    check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=remote, timeout=60)
+    check_call(["git", "clone", "-q", remote, source], timeout=60)
+    check_call(["git", "checkout", "-q", "-b", "master"], cwd=source, timeout=60)
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test")
+    for format_id in ["daisy202", "epub3"]:
+        shutil.copytree(os.path.join(test_dir, format_id), os.path.join(source, format_id))
+    check_call(["git", "add", "-A"], cwd=source, timeout=60)
+    check_call(["git", "commit", "-q", "-m", "copied test books to archive"], cwd=source, timeout=60)
+    check_call(["git", "push", "-q", "--set-upstream", "origin", "master"], cwd=source, timeout=60)
+    args = default_update_args(os.path.join(directory, "archive"), remote)
+    git_init(args)
+    return args
+
+
+def run_tests_set_mtime(directory, timestamp):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for path in [dirpath] + [os.path.join(dirpath, filename) for filename in filenames]:
+            os.utime(path, (timestamp, timestamp))
 
 
 def run_tests_prepend_html(filepath):
@@ -360,12 +1927,139 @@ def init_test():
     if not os.path.exists(tmp_remote) and not os.path.exists(os.path.join(tmp_local, ".git")):
         os.mkdir(tmp_remote, mode=0o755)
         check_call(["git", "init", "--bare"], cwd=tmp_remote, timeout=5)
+    return default_update_args(tmp_local, tmp_remote)
+
+
+def default_update_args(archive, git_url):
     args = argparse.Namespace()
-    args.archive = tmp_local
-    args.git_url = tmp_remote
+    args.archive = archive
+    args.git_url = git_url
     args.forever = False
+    args.watch = False
+    args.full_rescan_interval = 3600
+    args.push_batch_size = 1
+    args.push_batch_time = None
+    args.workers = 1
+    args.manifest = False
+    args.hash_workers = os.cpu_count() or 1
+    args.quiet_period = 0
+    args.max_settle_time = 600
+    args.async_push = False
+    args.porcelain = False
+    args.maintenance = False
+    args.batch_merge = False
+    args.offload_store = None
+    args.offload_threshold = 1000000
+    args.offload_pattern = []
+    args.stats_file = None
     return args
 
 
+def benchmark(args):
+    directory = args.directory or tempfile.mkdtemp(prefix="archive-benchmark-")
+    remote = os.path.join(directory, "remote")
+    local = os.path.join(directory, "local")
+    assert not os.path.exists(remote) and not os.path.exists(local), "Benchmark directory must be empty: " + directory
+    os.makedirs(remote)
+    check_call(["git", "init", "--bare", "-q"], cwd=remote, timeout=60)
+    update_args = default_update_args(local, remote)
+    update_args.workers = args.workers
+    update_args.push_batch_size = args.push_batch_size
+    update_args.manifest = args.manifest
+    update_args.porcelain = args.porcelain
+    git_init(update_args)
+    update_args.stats_file = None
+    
+    formats = args.formats.split(",")
+    print("Generating "+str(args.books)+" books with "+str(args.files_per_book)+" files each in "+local)
+    generation_started = time.time()
+    books = []
+    for i in range(args.books):
+        format_id = formats[i % len(formats)]
+        book_id = "BENCHMARK_BOOK_%06d" % i
+        benchmark_generate_book(os.path.join(local, format_id, book_id), args.files_per_book, args.media_size)
+        books.append((format_id, book_id))
+    
+    # books without an index row are only committed if they changed after the previous full scan started,
+    # so pretend that a scan started before the books were generated, however long that took
+    os.makedirs(os.path.join(local, ".db"), exist_ok=True)
+    index = ArchiveIndex(os.path.join(local, ".db"))
+    index.set_state("full_scan_started", generation_started)
+    index.close()
+    
+    rng = random.Random(0)
+    changed_count = max(1, int(len(books) * args.change_fraction))
+    scenarios = [
+        ("cold", lambda: None),
+        ("warm", lambda: None),
+        ("edit text", lambda: [benchmark_edit_text(os.path.join(local, f, b)) for f, b in rng.sample(books, changed_count)]),
+        ("replace media", lambda: [benchmark_generate_book(os.path.join(local, f, b), 0, args.media_size) for f, b in rng.sample(books, changed_count)]),
+        ("new books", lambda: [benchmark_generate_book(os.path.join(local, formats[0], "BENCHMARK_NEW_%06d" % i), args.files_per_book, args.media_size) for i in range(changed_count)]),
+        ("delete files", lambda: [os.remove(os.path.join(local, f, b, "content-0001.html")) for f, b in rng.sample(books, changed_count) if args.files_per_book > 1]),
+    ]
+    
+    results = []
+    tracemalloc.start()
+    for name, change in scenarios:
+        change()
+        remote_size = directory_size(remote)
+        tracemalloc.reset_peak()
+        start = time.monotonic()
+        update_iteration(update_args)
+        duration = time.monotonic() - start
+        stats = metrics.as_dict()
+        results.append({
+            "scenario": name,
+            "seconds": duration,
+            "subprocesses": sum(subprocess_stats["count"] for subprocess_stats in stats["subprocesses"].values()),
+            "peak_python_memory": tracemalloc.get_traced_memory()[1],
+            "pushed_bytes": directory_size(remote) - remote_size,
+            "phases": stats["phases"],
+            "counters": stats["counters"],
+        })
+    tracemalloc.stop()
+    
+    print()
+    print("%-15s %10s %8s %8s %8s %12s %14s" % ("scenario", "seconds", "scanned", "commits", "git", "pushed (kB)", "peak mem (kB)"))
+    for result in results:
+        print("%-15s %10.2f %8d %8d %8d %12d %14d" % (result["scenario"], result["seconds"],
+                                                       result["counters"].get("books_scanned", 0), result["counters"].get("commits", 0),
+                                                       result["subprocesses"], result["pushed_bytes"] / 1024, result["peak_python_memory"] / 1024))
+    print("Max RSS: "+str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)+" kB")
+    if results[0]["counters"].get("commits", 0) != len(books):
+        print("Warning: the cold update committed "+str(results[0]["counters"].get("commits", 0))+" of "+str(len(books))+" books")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2, default=str)
+    if not args.directory and not args.keep:
+        shutil.rmtree(directory)
+
+
+def benchmark_generate_book(book_dir, files_per_book, media_size):
+    """Writes `files_per_book - 1` small HTML files and one audio.wav of `media_size` random bytes into `book_dir`."""
+    os.makedirs(book_dir, exist_ok=True)
+    for i in range(1, files_per_book):
+        with open(os.path.join(book_dir, "content-%04d.html" % i), "w") as f:
+            f.write("<html><body><h1>%s</h1><p>Page %d</p></body></html>\n" % (os.path.basename(book_dir), i))
+    if media_size:
+        with open(os.path.join(book_dir, "audio.wav"), "wb") as f:
+            f.write(os.urandom(media_size))
+
+
+def benchmark_edit_text(book_dir):
+    for name in sorted(os.listdir(book_dir)):
+        if name.endswith(".html"):
+            run_tests_append_html(os.path.join(book_dir, name))
+            return
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
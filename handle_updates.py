@@ -7,50 +7,103 @@ if sys.version_info[0] != 3:
     sys.exit(1)
 
 #from urllib.parse import urlparse
-#import argparse
-#import os
-#import shutil
-#import re
-#import json
-#import tempfile
-#import time
-#import traceback
+import argparse
+import concurrent.futures
+import fcntl
+import hashlib
+import os
+import shlex
+import shutil
+import re
+import json
+import logging
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
 #from dateutil import parser
-#from datetime import datetime, timedelta
+from datetime import datetime
 from pprint import pprint
-#from subprocess import call, check_call, check_output
-#import socket
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack
+from subprocess import CalledProcessError, Popen, PIPE, DEVNULL
+import socket
+from archive_metrics import Metrics
+import yaml
+
+log = logging.getLogger("handle_updates")
+fetch_lock = threading.Lock()
 
 
 def main(argv):
-    # get lock to avoid multiple simultaneous instances of this script
-    get_lock(os.path.basename(__file__))
-    
     if '--run-tests' in argv:
+        configure_logging("INFO")
         run_tests("--forever" in argv)
     else:
-        # TODO
-#        parser = argparse.ArgumentParser(description="Monitors a book archive and commits changes to git.")
-#        subparsers = parser.add_subparsers(title='subcommands', metavar="")
-#        
-#        parser_update = subparsers.add_parser("update", help="Check archive for changes.")
-#        parser_update.add_argument("archive", help="Path to the archive.", metavar="PATH")
-#        parser_update.add_argument("-f", "--forever", help="Loop script forever.", action='store_true')
-#        parser_update.set_defaults(func=update)
-#        
-#        parser_init = subparsers.add_parser("git-init", help="Initialize archive from remote git repository.")
-#        parser_init.add_argument("archive", help="Path to the archive.", metavar="PATH")
-#        parser_init.add_argument("git_url", help="Initialize the archive from this git repository.", metavar="URL")
-#        parser_init.set_defaults(func=git_init)
+        parser = argparse.ArgumentParser(description="Converts books in a book archive when they change.")
+        subparsers = parser.add_subparsers(title='subcommands', metavar="")
+        
+        parser_update = subparsers.add_parser("update", help="Handle new commits in the archive.")
+        parser_update.add_argument("archive", help="Path to the archive.", metavar="PATH")
+        parser_update.add_argument("-f", "--forever", help="Loop script forever.", action='store_true')
+        parser_update.add_argument("--enqueue-only", help="Only add conversion jobs to the queue, and leave them to worker processes.", action='store_true')
+        add_conversion_arguments(parser_update)
+        add_queue_arguments(parser_update)
+        parser_update.set_defaults(func=update)
+        
+        parser_worker = subparsers.add_parser("worker", help="Run conversion jobs from the queue.")
+        parser_worker.add_argument("archive", help="Path to the archive (a clone of the same remote on other machines).", metavar="PATH")
+        parser_worker.add_argument("-f", "--forever", help="Wait for new jobs when the queue is empty.", action='store_true')
+        add_conversion_arguments(parser_worker)
+        add_queue_arguments(parser_worker)
+        parser_worker.set_defaults(func=worker)
+        
+        parser_convert = subparsers.add_parser("convert", help="Convert books in the archive.")
+        parser_convert.add_argument("archive", help="Path to the archive.", metavar="PATH")
+        parser_convert.add_argument("books", help="Books to convert, as format/book (for instance daisy202/TEST_BOOK_001).", metavar="BOOK", nargs="+")
+        add_conversion_arguments(parser_convert)
+        parser_convert.set_defaults(func=convert)
         
         args = parser.parse_args()
+        configure_logging(getattr(args, "log_level", "INFO"))
         if "func" in args:
             args.func(args)
         else:
             print(parser.format_help())
 
 
+def add_conversion_arguments(parser):
+    parser.add_argument("-c", "--config", help="Conversion config file (default: handle_updates.yml next to this script).", metavar="FILE",
+                        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "handle_updates.yml"))
+    parser.add_argument("-o", "--output", help="Directory where converted books are stored, as FORMAT/BOOK (default: .db/output in the archive).", metavar="DIR")
+    parser.add_argument("--workers", help="Number of conversions to run at the same time (default: 4).", metavar="N", type=int, default=4)
+    parser.add_argument("--max-per-image", help="Number of containers to run at the same time for each docker image (default: 2).", metavar="N", type=int, default=2)
+    parser.add_argument("--cpus-per-step", help="CPUs given to each container; also limits how many run at the same time (default: 1).", metavar="N", type=float, default=1)
+    parser.add_argument("--memory-per-step", help="Memory given to each container, in MB; also limits how many run at the same time (default: 2048).", metavar="MB", type=int, default=2048)
+    parser.add_argument("--docker", help="Docker executable (default: docker).", default="docker")
+    parser.add_argument("--stats-file", help="Write timings and counts to this file, after each iteration and each job; Prometheus textfile format if it ends with .prom, otherwise JSON.", metavar="FILE")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING or ERROR (default: INFO).", default="INFO")
+    parser.add_argument("--slots-dir", help="Directory with the lock files that limit how many containers run at the same time; shared by all processes on this host that use it (default: handle_updates-slots in the temporary directory).", metavar="DIR")
+    parser.add_argument("--cache", help="Directory where the output of each conversion step is cached (default: .db/cache in the archive).", metavar="DIR")
+    parser.add_argument("--cache-size", help="Maximum size of the cache in MB; the least recently used results are removed first. 0 disables the cache (default: 10240).", metavar="MB", type=int, default=10240)
+    parser.add_argument("--offload-store", help="The offload store of check_for_updates.py; books are exported with the offloaded media from the store instead of pointer files.", metavar="DIR")
+    parser.add_argument("--offload-threshold", help="As given to check_for_updates.py (default: 1000000).", metavar="BYTES", type=int, default=1000000)
+    parser.add_argument("--offload-pattern", help="As given to check_for_updates.py. Can be repeated.", metavar="PATTERN", action='append', default=[])
+
+
+def add_queue_arguments(parser):
+    parser.add_argument("--queue", help="Directory with the job queue and the last handled commit; can be shared by several machines if SQLite locking works on it, which is often not the case on NFS or SMB (default: .db in the archive).", metavar="DIR")
+    parser.add_argument("--lease-time", help="Seconds a job is reserved for a worker without a heartbeat, before other workers can take it over (default: 300).", metavar="SECONDS", type=int, default=300)
+    parser.add_argument("--max-attempts", help="Number of times a job is attempted before it is marked as failed (default: 3).", metavar="N", type=int, default=3)
+    parser.add_argument("--retry-delay", help="Seconds before a failed job is retried; doubled for each attempt (default: 60).", metavar="SECONDS", type=int, default=60)
+
+
 def update(args):
+    if getattr(args, "offload_store", None):
+        configure_offload_filter(normalize_args(args))
     if args.forever:
         while True:
             print()
@@ -70,15 +123,752 @@ def update(args):
             print()
     else:
         update_iteration(args)
-    
+
 
 def update_iteration(args):
+    metrics.reset()
+    try:
+        with metrics.phase("iteration"):
+            update_iteration_phases(args)
+    finally:
+        write_stats(args)
+
+
+def write_stats(args):
+    if getattr(args, "stats_file", None):
+        metrics.write(args.stats_file)
+
+
+def update_iteration_phases(args):
     print("---------------------------")
     print("  check for updates        ")
     print("---------------------------")
     args = normalize_args(args)
     
-    # TODO
+    index = UpdateIndex(queue_dir(args))
+    try:
+        # only one process per host checks for new commits; other processes only convert
+        if get_lock(os.path.basename(__file__)):
+            enqueue_new_commits(args, index)
+        else:
+            log.info("Another process is checking for new commits")
+        
+        if not args.enqueue_only:
+            run_worker(args, forever=False)
+    finally:
+        index.close()
+
+
+def enqueue_new_commits(args, index):
+    """Adds conversion jobs for the books that have changed in master since the last handled commit."""
+    with metrics.phase("fetch"):
+        check_call(["git", "fetch", "origin"], cwd=args.archive, timeout=3600)
+    head = check_output(["git", "rev-parse", "--verify", "origin/master^{commit}"], cwd=args.archive, universal_newlines=True, timeout=60).strip()
+    
+    cursor = index.get_state("cursor")
+    start_cursor = cursor
+    if cursor is not None and call(["git", "cat-file", "-e", cursor+"^{commit}"], cwd=args.archive, stderr=DEVNULL, timeout=60) != 0:
+        log.warning("The last handled commit ("+cursor+") no longer exists; starting over from "+head)
+        cursor = None
+    if cursor == head:
+        log.info("No new commits")
+        return
+    
+    jobs = []
+    if cursor is None:
+        log.info("Only commits after "+head+" will be handled (use the convert subcommand to convert existing books)")
+    else:
+        with metrics.phase("read_commits"):
+            changed_books = read_new_commits(args.archive, cursor, head)
+            existing_books = list_existing_books(args.archive, head, changed_books.keys())
+        for (format_id, book_id), commits in changed_books.items():
+            log.info(format_id+"/"+book_id+": changed in "+str(len(commits))+" commit"+("" if len(commits) == 1 else "s")
+                     + ("" if (format_id, book_id) in existing_books else " (deleted; not converted)"))
+        metrics.count("books_changed", len(changed_books))
+        jobs = conversion_jobs(load_config(args.config), [book for book in changed_books if book in existing_books])
+    
+    # the cursor is only moved if no other machine sharing the queue has moved it in the meantime
+    with metrics.phase("enqueue"), index.transaction():
+        if index.get_state("cursor") != start_cursor:
+            log.info("The commits have already been handled by another process")
+            return
+        index.enqueue_jobs([(format_id, book_id, target_format_id, head) for format_id, book_id, target_format_id, steps in jobs])
+        index.set_state("cursor", head)
+    metrics.count("jobs_enqueued", len(jobs))
+    if jobs:
+        log.info("Added "+str(len(jobs))+" conversion job"+("" if len(jobs) == 1 else "s")+" to the queue")
+
+
+def worker(args):
+    args = normalize_args(args)
+    if getattr(args, "offload_store", None):
+        configure_offload_filter(args)
+    run_worker(args, forever=args.forever)
+
+
+def run_worker(args, forever):
+    """Runs conversion jobs from the queue on `--workers` threads until there are none ready to run (or forever)."""
+    config = load_config(args.config)
+    output_dir = args.output or os.path.join(args.archive, ".db", "output")
+    limits = ConversionLimits(args)
+    cache = None
+    if args.cache_size > 0:
+        cache = ConversionCache(args, args.cache or os.path.join(args.archive, ".db", "cache"), args.cache_size * 1024 * 1024)
+    owner = socket.gethostname()+":"+str(os.getpid())
+    heartbeat = LeaseHeartbeat(UpdateIndex(queue_dir(args)), owner, args.lease_time)
+    threads = [threading.Thread(target=run_jobs, args=(args, config, limits, cache, output_dir, heartbeat, owner, forever), name="worker-"+str(number))
+               for number in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    heartbeat.stop()
+    if cache:
+        cache.close()
+
+
+def run_jobs(args, config, limits, cache, output_dir, heartbeat, owner, forever):
+    """Claims and runs jobs from the queue, one at a time, until there are no jobs ready to run (or forever)."""
+    index = UpdateIndex(queue_dir(args))
+    try:
+        while True:
+            try:
+                job = index.claim_job(owner, args.lease_time, args.max_attempts)
+            except sqlite3.OperationalError as e:
+                log.warning("Could not claim a job from the queue: "+str(e))
+                job = None
+            if job is None:
+                if not forever:
+                    return
+                time.sleep(5)
+                continue
+            
+            description = job.format_id+"/"+job.book_id+" -> "+job.target_format_id
+            heartbeat.add(job.id)
+            try:
+                steps = config.get(job.format_id, {}).get("conversions", {}).get(job.target_format_id)
+                if not steps:
+                    raise Exception("No conversion defined from "+job.format_id+" to "+job.target_format_id)
+                ensure_revision(args, job.revision)
+                run_conversion(args, limits, cache, output_dir, job.revision, job.format_id, job.book_id, job.target_format_id, steps)
+                if index.finish_job(job, owner):
+                    log.info(description+": success")
+                    metrics.count("jobs_succeeded")
+                else:
+                    log.warning(description+": finished, but the job had been taken over by another worker")
+                    metrics.count("jobs_lost")
+            except Exception as e:
+                state = index.fail_job(job, owner, str(e), args.max_attempts, args.retry_delay)
+                log.error(description+": attempt "+str(job.attempts)+" failed ("+state+"): "+str(e))
+                metrics.count({"queued": "jobs_retried", "superseded": "jobs_superseded"}.get(state, "jobs_failed"))
+            finally:
+                heartbeat.remove(job.id)
+                write_stats(args)
+    finally:
+        index.close()
+
+
+def ensure_revision(args, revision):
+    """Fetches from the remote if a revision (from a job added on another machine) is not in the archive yet."""
+    with fetch_lock:
+        if call(["git", "cat-file", "-e", revision+"^{commit}"], cwd=args.archive, stderr=DEVNULL, timeout=60) != 0:
+            check_call(["git", "fetch", "origin"], cwd=args.archive, timeout=3600)
+
+
+def queue_dir(args):
+    directory = getattr(args, "queue", None) or os.path.join(args.archive, ".db")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def read_new_commits(archive, cursor, head):
+    """Returns lists of the commits (oldest first) between cursor and head, keyed on (format_id, book_id)."""
+    log_output = check_output(["git", "-c", "core.quotePath=false", "log", "--reverse", "--first-parent", "-m", "--name-only", "--format=%x00%H", cursor+".."+head],
+                              cwd=archive, universal_newlines=True, timeout=3600)
+    changed_books = {}
+    commit = None
+    for line in log_output.splitlines():
+        if line.startswith("\0"):
+            commit = line[1:]
+            continue
+        parts = line.split("/")
+        if len(parts) < 3 or commit is None:
+            continue
+        format_id, book_id = parts[0], parts[1]
+        if format_id.startswith(".") or format_id.startswith("_") or book_id.startswith(".") or book_id.startswith("_"):
+            continue
+        commits = changed_books.setdefault((format_id, book_id), [])
+        if not commits or commits[-1] != commit:
+            commits.append(commit)
+    return changed_books
+
+
+def list_existing_books(archive, revision, books):
+    """Returns the (format_id, book_id) in books that exist in the given revision."""
+    books = set(books)
+    existing_books = set()
+    for format_id in sorted(set(format_id for format_id, book_id in books)):
+        ls_tree_output = check_output(["git", "-c", "core.quotePath=false", "ls-tree", "-d", "--name-only", revision, "--", format_id+"/"],
+                                      cwd=archive, universal_newlines=True, timeout=60)
+        existing_books.update(tuple(line.split("/", 1)) for line in ls_tree_output.splitlines() if "/" in line)
+    return existing_books & books
+
+
+def export_book(archive, revision, format_id, book_id, target_dir):
+    """Extracts a book as of the given revision into target_dir using `git archive`, and returns the path to the book."""
+    process = Popen(["git", "archive", "--format=tar", revision, "--", format_id+"/"+book_id], cwd=archive, stdout=PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(target_dir, filter="data")
+            else:
+                tar.extractall(target_dir)
+    finally:
+        process.stdout.close()
+        returncode = process.wait(timeout=3600)
+    if returncode != 0:
+        raise Exception("git archive failed for "+format_id+"/"+book_id+" at "+revision)
+    return os.path.join(target_dir, format_id, book_id)
+
+
+Job = namedtuple("Job", "id format_id book_id target_format_id revision attempts")
+
+
+class UpdateIndex:
+    """SQLite database with the state and the job queue of this script."""
+    
+    def __init__(self, db_dir):
+        self.filename = os.path.join(db_dir, "handle_updates.sqlite")
+        self.local = threading.local()
+        with self.transaction():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "format_id TEXT NOT NULL, book_id TEXT NOT NULL, target_format_id TEXT NOT NULL, revision TEXT NOT NULL, "
+                                    "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL, "
+                                    "lease_owner TEXT, lease_expires REAL, error TEXT, updated REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, format_id, book_id, target_format_id)")
+    
+    @property
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            # transactions are started explicitly with BEGIN IMMEDIATE, see transaction()
+            self.local.connection = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        return self.local.connection
+    
+    def close(self):
+        """Closes the connection of the current thread."""
+        if getattr(self.local, "connection", None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+    
+    @contextmanager
+    def transaction(self):
+        """Runs a block in a write transaction. Only one process at a time can be in a write transaction."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+    
+    def get_state(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+    
+    def set_state(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value)))
+    
+    def enqueue_jobs(self, jobs):
+        """Adds jobs as (format_id, book_id, target_format_id, revision), updating jobs that are still queued."""
+        now = time.time()
+        for format_id, book_id, target_format_id, revision in jobs:
+            updated = self.connection.execute("UPDATE jobs SET revision = ?, attempts = 0, not_before = ?, error = NULL, updated = ? "
+                                              "WHERE state = 'queued' AND format_id = ? AND book_id = ? AND target_format_id = ?",
+                                              (revision, now, now, format_id, book_id, target_format_id)).rowcount
+            if not updated:
+                self.connection.execute("INSERT INTO jobs (format_id, book_id, target_format_id, revision, state, not_before, updated) "
+                                        "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                                        (format_id, book_id, target_format_id, revision, now, now))
+        
+        # forget finished jobs after a week
+        self.connection.execute("DELETE FROM jobs WHERE state IN ('done', 'failed', 'superseded') AND updated < ?", (now - 7 * 24 * 3600,))
+    
+    def claim_job(self, owner, lease_time, max_attempts):
+        """Leases the oldest job that is ready to run to owner, and returns it; or None if there is none."""
+        while True:
+            now = time.time()
+            with self.transaction():
+                row = self.connection.execute("SELECT id, format_id, book_id, target_format_id, revision, attempts FROM jobs AS job "
+                                              "WHERE ((state = 'queued' AND not_before <= :now) OR (state = 'running' AND lease_expires < :now)) "
+                                              "AND NOT EXISTS (SELECT 1 FROM jobs AS running WHERE running.state = 'running' AND running.lease_expires >= :now "
+                                              "AND running.format_id = job.format_id AND running.book_id = job.book_id AND running.target_format_id = job.target_format_id) "
+                                              "ORDER BY id LIMIT 1", {"now": now}).fetchone()
+                if row is None:
+                    return None
+                job = Job(*row)
+                if self.has_newer_job(job):
+                    # a retry or an expired job, for a conversion that has been queued again since
+                    self.connection.execute("UPDATE jobs SET state = 'superseded', lease_owner = NULL, updated = ? WHERE id = ?", (now, job.id))
+                    continue
+                if job.attempts >= max_attempts:
+                    # the last attempt was by a worker that died
+                    self.connection.execute("UPDATE jobs SET state = 'failed', lease_owner = NULL, error = 'lease expired', updated = ? WHERE id = ?", (now, job.id))
+                    continue
+                self.connection.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ?",
+                                        (owner, now + lease_time, now, job.id))
+                return job._replace(attempts=job.attempts + 1)
+    
+    def renew_leases(self, owner, job_ids, lease_time):
+        """Extends the leases of the given jobs, and returns the IDs of the jobs that are no longer leased to owner."""
+        now = time.time()
+        lost = []
+        with self.transaction():
+            for job_id in job_ids:
+                if not self.connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                                               (now + lease_time, job_id, owner)).rowcount:
+                    lost.append(job_id)
+        return lost
+    
+    def finish_job(self, job, owner):
+        """Marks a job as done. Returns False if the job was no longer leased to owner."""
+        with self.transaction():
+            return bool(self.connection.execute("UPDATE jobs SET state = 'done', lease_owner = NULL, error = NULL, updated = ? "
+                                                "WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                                                (time.time(), job.id, owner)).rowcount)
+    
+    def fail_job(self, job, owner, error, max_attempts, retry_delay):
+        """Queues a failed job to be retried, or marks it as failed or superseded. Returns the new state."""
+        now = time.time()
+        state = "queued" if job.attempts < max_attempts else "failed"
+        with self.transaction():
+            if self.has_newer_job(job):
+                state = "superseded"
+            self.connection.execute("UPDATE jobs SET state = ?, not_before = ?, lease_owner = NULL, error = ?, updated = ? "
+                                    "WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                                    (state, now + retry_delay * 2 ** (job.attempts - 1), error, now, job.id, owner))
+        return state
+    
+    def has_newer_job(self, job):
+        """Returns True if a job for the same conversion has been added after the given job."""
+        return self.connection.execute("SELECT 1 FROM jobs WHERE id > ? AND format_id = ? AND book_id = ? AND target_format_id = ?",
+                                       (job.id, job.format_id, job.book_id, job.target_format_id)).fetchone() is not None
+
+
+class LeaseHeartbeat:
+    """Thread that renews the leases of the jobs run by this process, so that other workers do not take them over."""
+    
+    def __init__(self, index, owner, lease_time):
+        self.index = index
+        self.owner = owner
+        self.lease_time = lease_time
+        self.job_ids = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lease-heartbeat", daemon=True)
+        self.thread.start()
+    
+    def add(self, job_id):
+        with self.lock:
+            self.job_ids.add(job_id)
+    
+    def remove(self, job_id):
+        with self.lock:
+            self.job_ids.discard(job_id)
+    
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lease_time / 3):
+                with self.lock:
+                    job_ids = list(self.job_ids)
+                if not job_ids:
+                    continue
+                try:
+                    for job_id in self.index.renew_leases(self.owner, job_ids, self.lease_time):
+                        log.warning("Lost the lease of job "+str(job_id)+"; it may be run by another worker")
+                except sqlite3.OperationalError as e:
+                    log.warning("Could not renew leases: "+str(e))
+        finally:
+            self.index.close()
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def convert(args):
+    args = normalize_args(args)
+    if getattr(args, "offload_store", None):
+        configure_offload_filter(args)
+    books = []
+    for book in args.books:
+        format_id, book_id = os.path.normpath(book).split(os.sep)[-2:]
+        books.append((format_id, book_id))
+    metrics.reset()
+    try:
+        results = convert_books(args, books)
+    finally:
+        write_stats(args)
+    if any(result != "success" for result in results.values()):
+        sys.exit(1)
+
+
+def convert_books(args, books, revision=None):
+    """Converts books to all the formats they can be converted to. Returns "success" or an error, keyed on (format_id, book_id, target_format_id)."""
+    jobs = conversion_jobs(load_config(args.config), books)
+    if not jobs:
+        return {}
+    
+    output_dir = args.output or os.path.join(args.archive, ".db", "output")
+    limits = ConversionLimits(args)
+    cache = None
+    if revision and args.cache_size > 0:
+        cache = ConversionCache(args, args.cache or os.path.join(args.archive, ".db", "cache"), args.cache_size * 1024 * 1024)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_conversion, args, limits, cache, output_dir, revision, *job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            format_id, book_id, target_format_id, steps = futures[future]
+            try:
+                future.result()
+                results[(format_id, book_id, target_format_id)] = "success"
+            except Exception as e:
+                log.error("Conversion of "+format_id+"/"+book_id+" to "+target_format_id+" failed: "+str(e))
+                results[(format_id, book_id, target_format_id)] = str(e)
+    if cache:
+        cache.close()
+    for (format_id, book_id, target_format_id), result in sorted(results.items()):
+        print(format_id+"/"+book_id+" -> "+target_format_id+": "+result)
+    return results
+
+
+def conversion_jobs(config, books):
+    """Returns (format_id, book_id, target_format_id, steps) for every conversion of the given (format_id, book_id)."""
+    jobs = []
+    for format_id, book_id in books:
+        if format_id not in config:
+            log.warning("No conversions defined for "+format_id+"; skipping "+format_id+"/"+book_id)
+            continue
+        for target_format_id, steps in config[format_id]["conversions"].items():
+            jobs.append((format_id, book_id, target_format_id, steps))
+    return jobs
+
+
+def load_config(config_filename):
+    """Loads the conversion config, and checks that all steps are valid."""
+    with open(config_filename) as f:
+        config = yaml.safe_load(f) or {}
+    for format_id in config:
+        conversions = config[format_id].get("conversions") or {}
+        for target_format_id in conversions:
+            steps = conversions[target_format_id]
+            if isinstance(steps, str):
+                steps = [steps]
+            for step in steps:
+                parse_step(step)
+            conversions[target_format_id] = steps
+        config[format_id]["conversions"] = conversions
+    return config
+
+
+def parse_step(step):
+    """Returns (image, arguments) for a step of the form `docker IMAGE [ARGUMENTS...]`."""
+    parts = shlex.split(step)
+    if len(parts) < 2 or parts[0] != "docker":
+        raise Exception("Unsupported conversion step (expected 'docker IMAGE [ARGUMENTS...]'): "+step)
+    return parts[1], parts[2:]
+
+
+class ConversionLimits:
+    """Limits how many containers run at the same time, per image and on this host."""
+    
+    def __init__(self, args):
+        self.slots_dir = args.slots_dir or os.path.join(tempfile.gettempdir(), "handle_updates-slots")
+        os.makedirs(self.slots_dir, exist_ok=True)
+        self.max_per_image = args.max_per_image
+        host_slots = int((os.cpu_count() or 1) // args.cpus_per_step)
+        memory = total_memory()
+        if memory is not None:
+            host_slots = min(host_slots, memory // (args.memory_per_step * 1024 * 1024))
+        self.host_slots = max(1, host_slots)
+    
+    def host(self):
+        return self.slot("host", self.host_slots)
+    
+    def image(self, image):
+        return self.slot("image-"+re.sub(r"[^A-Za-z0-9_.-]", "_", image), self.max_per_image)
+    
+    @contextmanager
+    def slot(self, name, slots):
+        """Waits until one of `slots` lock files for name can be locked, and holds the lock until the block ends."""
+        fd = None
+        while fd is None:
+            for number in range(slots):
+                candidate = os.open(os.path.join(self.slots_dir, name+"."+str(number)), os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fd = candidate
+                    break
+                except BlockingIOError:
+                    os.close(candidate)
+            if fd is None:
+                time.sleep(0.5)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def total_memory():
+    """Returns the total memory of the host in bytes, or None if it is unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_conversion(args, limits, cache, output_dir, revision, format_id, book_id, target_format_id, steps):
+    """Runs the steps of a conversion, resuming after the last cached step, and stores the result in output_dir."""
+    target_dir = os.path.join(output_dir, target_format_id, format_id)
+    os.makedirs(target_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=".convert-", dir=target_dir) as work_dir:
+        keys = [None] * len(steps)
+        first_step = 0
+        step_input = None
+        checked_out = []
+        try:
+            if cache:
+                tree_hash = check_output(["git", "rev-parse", "--verify", revision+":"+format_id+"/"+book_id], cwd=args.archive, universal_newlines=True, timeout=60).strip()
+                keys = cache.step_keys(tree_hash, [parse_step(step) for step in steps])
+                for number in reversed(range(len(steps))):
+                    step_input = cache.checkout(keys[number])
+                    if step_input:
+                        checked_out.append(keys[number])
+                        first_step = number + 1
+                        log.info(format_id+"/"+book_id+" -> "+target_format_id+": using cached output of step "+str(first_step)+"/"+str(len(steps)))
+                        metrics.count("steps_cached", first_step)
+                        break
+            if not step_input:
+                if revision:
+                    with metrics.phase("export"):
+                        step_input = export_book(args.archive, revision, format_id, book_id, os.path.join(work_dir, "input"))
+                else:
+                    step_input = os.path.join(args.archive, format_id, book_id)
+                if not os.path.isdir(step_input):
+                    raise Exception("Book does not exist: "+step_input)
+            
+            for number in range(first_step, len(steps)):
+                image, arguments = parse_step(steps[number])
+                step_output = os.path.join(work_dir, "step-"+str(number + 1))
+                os.mkdir(step_output)
+                log.info(format_id+"/"+book_id+" -> "+target_format_id+": step "+str(number + 1)+"/"+str(len(steps))+" ("+image+")")
+                start = time.monotonic()
+                with ExitStack() as slots:
+                    with metrics.phase("wait"):
+                        # wait for the image first, so that steps waiting for a busy image do not hold host slots
+                        slots.enter_context(limits.image(image))
+                        slots.enter_context(limits.host())
+                    with metrics.phase("convert"):
+                        run_step(args, image, arguments, step_input, step_output)
+                log.info(format_id+"/"+book_id+" -> "+target_format_id+": step "+str(number + 1)+" took %.1f seconds" % (time.monotonic() - start))
+                metrics.count("steps_run")
+                if cache:
+                    with metrics.phase("cache"):
+                        cache.store(keys[number], step_output)
+                step_input = step_output
+            
+            if first_step == len(steps):
+                # everything was cached; copy the cached result instead of moving it out of the cache
+                step_output = os.path.join(work_dir, "result")
+                shutil.copytree(step_input, step_output, symlinks=True)
+                step_input = step_output
+        finally:
+            for key in checked_out:
+                cache.release(key)
+        
+        # replace the previous result
+        result_dir = os.path.join(target_dir, book_id)
+        previous_dir = os.path.join(work_dir, "previous")
+        if os.path.exists(result_dir):
+            os.rename(result_dir, previous_dir)
+        os.rename(step_input, result_dir)
+
+
+class ConversionCache:
+    """Cache of the output of conversion steps."""
+    
+    def __init__(self, args, cache_dir, max_size):
+        self.args = args
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.owner = socket.gethostname()+":"+str(os.getpid())
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        # transactions are started explicitly with BEGIN IMMEDIATE, as the cache can be shared by several processes
+        self.connection = sqlite3.connect(os.path.join(cache_dir, "cache.sqlite"), timeout=60, check_same_thread=False, isolation_level=None)
+        with self.transaction():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS in_use (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, owner TEXT NOT NULL, since REAL NOT NULL)")
+            # forget outputs held by processes on this host that are no longer running
+            host = socket.gethostname()+":"
+            for row_id, owner in self.connection.execute("SELECT id, owner FROM in_use").fetchall():
+                if owner.startswith(host) and not process_exists(int(owner[len(host):])):
+                    self.connection.execute("DELETE FROM in_use WHERE id = ?", (row_id,))
+    
+    def close(self):
+        self.connection.close()
+    
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+    
+    def image_digest(self, image):
+        """Returns the ID of a docker image, pulling the image if it is not available locally."""
+        command = [self.args.docker, "image", "inspect", "--format", "{{.Id}}", image]
+        try:
+            return check_output(command, universal_newlines=True, stderr=DEVNULL, timeout=60).strip()
+        except CalledProcessError:
+            check_call([self.args.docker, "pull", image], timeout=3600)
+            return check_output(command, universal_newlines=True, timeout=60).strip()
+    
+    def step_keys(self, tree_hash, steps):
+        """Returns the cache keys for a list of (image, arguments) applied in order to a git tree."""
+        keys = []
+        digests = {}
+        key = "tree:"+tree_hash
+        for image, arguments in steps:
+            if image not in digests:
+                digests[image] = self.image_digest(image)
+            key = hashlib.sha256(json.dumps([key, digests[image], arguments]).encode("utf-8")).hexdigest()
+            keys.append(key)
+        return keys
+    
+    def path(self, key):
+        return os.path.join(self.cache_dir, "objects", key)
+    
+    def checkout(self, key):
+        """Returns the cached output for a key, and keeps it from being removed until it is released; or None if it is not cached."""
+        now = time.time()
+        with self.transaction():
+            row = self.connection.execute("SELECT key FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or not os.path.isdir(self.path(key)):
+                return None
+            self.connection.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+            self.connection.execute("INSERT INTO in_use (key, owner, since) VALUES (?, ?, ?)", (key, self.owner, now))
+        return self.path(key)
+    
+    def release(self, key):
+        with self.transaction():
+            self.connection.execute("DELETE FROM in_use WHERE id = (SELECT id FROM in_use WHERE key = ? AND owner = ? LIMIT 1)", (key, self.owner))
+    
+    def store(self, key, output_dir):
+        """Adds a copy of the output of a step to the cache, and removes old outputs if the cache is too big."""
+        temporary_dir = tempfile.mkdtemp(prefix=".store-", dir=self.cache_dir)
+        try:
+            shutil.copytree(output_dir, os.path.join(temporary_dir, key), symlinks=True)
+            with self.transaction():
+                if self.connection.execute("SELECT key FROM cache WHERE key = ?", (key,)).fetchone() is not None:
+                    # another conversion stored the same output first
+                    return
+                if os.path.exists(self.path(key)):
+                    # left behind by a process that died while storing it
+                    os.rename(self.path(key), os.path.join(temporary_dir, "leftover"))
+                os.rename(os.path.join(temporary_dir, key), self.path(key))
+                self.connection.execute("INSERT INTO cache VALUES (?, ?, ?)", (key, directory_size(self.path(key)), time.time()))
+                removed = self.evict(temporary_dir)
+        finally:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+        if removed:
+            log.info("Removed "+str(removed)+" old output"+("" if removed == 1 else "s")+" from the cache")
+            metrics.count("cache_evicted", removed)
+    
+    def evict(self, trash_dir):
+        """Moves the least recently used outputs to trash_dir until the cache fits. Returns the number of outputs removed."""
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_size <= self.max_size:
+            return 0
+        # a conversion step times out after a day; anything held for longer was held by a process that died
+        self.connection.execute("DELETE FROM in_use WHERE since < ?", (time.time() - 2 * 86400,))
+        removed = []
+        rows = self.connection.execute("SELECT key, size FROM cache WHERE key NOT IN (SELECT key FROM in_use) ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            if os.path.exists(self.path(key)):
+                os.rename(self.path(key), os.path.join(trash_dir, "evicted-"+key))
+            removed.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", removed)
+        return len(removed)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def directory_size(path):
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                total_size += os.path.getsize(filepath)
+    return total_size
+
+
+def call(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.call(command, **kwargs)
+
+
+def check_call(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.check_call(command, **kwargs)
+
+
+def check_output(command, **kwargs):
+    with metrics.subprocess(command):
+        return subprocess.check_output(command, **kwargs)
+
+
+metrics = Metrics("git_book_archive_conversion")
+
+
+def configure_logging(level):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+def run_step(args, image, arguments, input_dir, output_dir):
+    command = [args.docker, "run", "--rm",
+               "--cpus", str(args.cpus_per_step),
+               "--memory", str(args.memory_per_step)+"m",
+               "-v", os.path.abspath(input_dir)+":/input:ro",
+               "-v", os.path.abspath(output_dir)+":/output",
+               image] + arguments
+    check_call(command, timeout=86400)
 
 
 def load_data(db_filename):
@@ -108,22 +898,44 @@ def modification_date(filename):
 
 
 def normalize_args(args):
-    #args.archive = os.path.normpath(args.archive)
+    args.archive = os.path.normpath(args.archive)
     return args
 
 
+def configure_offload_filter(args):
+    """Configures the offload filter of check_for_updates.py in the archive (see configure_offload_filter there)."""
+    store = os.path.abspath(args.offload_store)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), "check_for_updates.py"), "offload-filter", "--store", store, "--threshold", str(args.offload_threshold)]
+    for pattern in args.offload_pattern:
+        command += ["--pattern", pattern]
+    check_call(["git", "config", "filter."+OFFLOAD_FILTER+".process", " ".join(shlex.quote(part) for part in command)], cwd=args.archive, timeout=60)
+    check_call(["git", "config", "filter."+OFFLOAD_FILTER+".required", "true"], cwd=args.archive, timeout=60)
+
+
+OFFLOAD_FILTER = "archive-offload"
+
+
+lock_socket = None
+
+
 def get_lock(process_name):
+    """Returns True if this process holds the lock for process_name (taking it if it is free), and False if another process holds it."""
     # http://stackoverflow.com/a/7758075/281065
     if not(sys.platform == "linux" or sys.platform == "linux2"):
         print("WARNING: trying to aquire lock on non-Linux system")
     global lock_socket # Without this our lock gets garbage collected
-    lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    if lock_socket is not None:
+        return True
+    candidate_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
     try:
-        lock_socket.bind('\0' + process_name)
+        candidate_socket.bind('\0' + process_name)
         print('I got the lock')
     except socket.error:
         print('lock exists')
-        sys.exit()
+        candidate_socket.close()
+        return False
+    lock_socket = candidate_socket
+    return True
 
 
 def run_tests(forever):
@@ -133,16 +945,185 @@ def run_tests(forever):
             time.sleep(60)
     else:
         run_tests_iteration()
-    
-    
+
+
 def run_tests_iteration():
     args = init_test()
-    # TODO
+    source = os.path.join(os.path.dirname(args.archive), "conversion-source")
+    book_dir = os.path.join(source, "daisy202", "TEST_BOOK_001")
+    output_dir = os.path.join(args.archive, ".db", "output")
+    
+    print("---------------------------")
+    print("  first update             ")
+    print("---------------------------")
+    update(args)
+    index = UpdateIndex(queue_dir(args))
+    assert index.get_state("cursor") == run_tests_head(source), "The first update should only store the current commit"
+    
+    print("---------------------------")
+    print("  convert a changed book   ")
+    print("---------------------------")
+    run_tests_append_html(os.path.join(book_dir, "content.html"))
+    run_tests_commit(source, "Updated book: TEST_BOOK_001")
+    update(args)
+    run_tests_check(args, index, output_dir, book_dir, steps_run=3, steps_cached=0)
+    assert metrics.counters.get("books_changed") == 1, "Only TEST_BOOK_001 has changed: " + str(metrics.counters)
+    with open(os.path.join(output_dir, "epub3", "daisy202", "TEST_BOOK_001", "steps.txt")) as f:
+        assert f.read().split() == ["josteinaj/conversion-path-1", "josteinaj/conversion-path-2"], "The steps should run in order"
+    
+    print("---------------------------")
+    print("  revert the change        ")
+    print("---------------------------")
+    check_call(["git", "revert", "--no-edit", "HEAD"], cwd=source, stdout=DEVNULL, timeout=60)
+    check_call(["git", "push", "-q"], cwd=source, timeout=60)
     update(args)
+    run_tests_check(args, index, output_dir, book_dir, steps_run=3, steps_cached=0)
+    
+    print("---------------------------")
+    print("  queue, worker and cache  ")
+    print("---------------------------")
+    # the book is back to the version converted above, so every step is in the cache
+    check_call(["git", "revert", "--no-edit", "HEAD"], cwd=source, stdout=DEVNULL, timeout=60)
+    check_call(["git", "push", "-q"], cwd=source, timeout=60)
+    args.enqueue_only = True
+    update(args)
+    queued = index.connection.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+    assert queued == 2, "Expected 2 queued jobs with --enqueue-only, found " + str(queued)
+    args.enqueue_only = False
+    metrics.reset()
+    worker(args)
+    run_tests_check(args, index, output_dir, book_dir, steps_run=0, steps_cached=3)
+    
+    print("---------------------------")
+    print("  stale jobs               ")
+    print("---------------------------")
+    # a job that fails after the conversion has been queued again must not be retried, or its
+    # output could overwrite the output of the newer job
+    index.enqueue_jobs([("daisy202", "TEST_BOOK_STALE", "epub3", "rev1")])
+    stale_job = index.claim_job("test", args.lease_time, 3)
+    index.enqueue_jobs([("daisy202", "TEST_BOOK_STALE", "epub3", "rev2")])
+    assert index.fail_job(stale_job, "test", "test failure", 3, 0) == "superseded", "A failed job should be superseded by a newer job"
+    job = index.claim_job("test", args.lease_time, 3)
+    assert job is not None and job.revision == "rev2", "The newer job should be claimed: " + str(job)
+    assert index.finish_job(job, "test"), "The newer job should be finished"
+    job = index.claim_job("test", args.lease_time, 3)
+    assert job is None, "The old job should not be claimed after the newer job has finished: " + str(job)
+    index.close()
+    print("All tests passed")
+
+
+def run_tests_check(args, index, output_dir, book_dir, steps_run, steps_cached):
+    """Checks that all jobs are done, how many steps were run and cached, and that the result is the book as committed."""
+    states = dict(index.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+    assert list(states) == ["done"], "All jobs should be done: " + str(states)
+    assert metrics.counters.get("steps_run", 0) == steps_run, "Expected " + str(steps_run) + " steps to run: " + str(metrics.counters)
+    assert metrics.counters.get("steps_cached", 0) == steps_cached, "Expected " + str(steps_cached) + " cached steps: " + str(metrics.counters)
+    with open(os.path.join(book_dir, "content.html")) as f:
+        expected = f.read()
+    for target_format_id in ["epub3", "pef"]:
+        with open(os.path.join(output_dir, target_format_id, "daisy202", "TEST_BOOK_001", "content.html")) as f:
+            assert f.read() == expected, "The " + target_format_id + " result is not the committed version of the book"
+
+
+def run_tests_append_html(filepath):
+    with open(filepath) as f:
+        content = f.readlines()
+    with open(filepath, 'w') as f:
+        for line in content:
+            if ("</body" in line):
+                f.write("        <p>%s</p>\n" % datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f UTC"))
+            f.write("%s" % line)
+
+
+def run_tests_commit(repository, message):
+    check_call(["git", "add", "-A"], cwd=repository, timeout=60)
+    check_call(["git", "commit", "-q", "-m", message], cwd=repository, timeout=60)
+    check_call(["git", "push", "-q"], cwd=repository, timeout=60)
+
+
+def run_tests_head(repository):
+    return check_output(["git", "rev-parse", "HEAD"], cwd=repository, universal_newlines=True, timeout=60).strip()
+
+
+# Stands in for docker: `image inspect` prints an ID derived from the image name, and `run`
+# copies /input to /output and appends the image to steps.txt in the output.
+TEST_DOCKER = """#!%s
+import hashlib, shutil, sys
+arguments = sys.argv[1:]
+if arguments[:2] == ["image", "inspect"]:
+    print("sha256:" + hashlib.sha256(arguments[-1].encode("utf-8")).hexdigest())
+elif arguments[:1] == ["run"]:
+    arguments = arguments[1:]
+    mounts = {}
+    while arguments[0].startswith("-"):
+        if arguments[0] == "--rm":
+            arguments = arguments[1:]
+            continue
+        if arguments[0] == "-v":
+            host, container = arguments[1].split(":")[:2]
+            mounts[container] = host
+        arguments = arguments[2:]
+    shutil.copytree(mounts["/input"], mounts["/output"], dirs_exist_ok=True)
+    with open(mounts["/output"] + "/steps.txt", "a") as f:
+        f.write(arguments[0] + "\\n")
+elif arguments[:1] != ["pull"]:
+    sys.exit(1)
+"""
 
 
 def init_test():
-    # TODO
+    """Creates a remote with the test books, a clone to commit in (conversion-source) and a clone to convert from."""
+    tmp_parent = tempfile.gettempdir()
+    tmp_remote = os.path.join(tmp_parent, "conversion-remote")
+    tmp_source = os.path.join(tmp_parent, "conversion-source")
+    tmp_archive = os.path.join(tmp_parent, "conversion-archive")
+    tmp_slots = os.path.join(tmp_parent, "conversion-slots")
+    for directory in [tmp_remote, tmp_source, tmp_archive, tmp_slots]:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+    
+    os.mkdir(tmp_remote, mode=0o755)
+    check_call(["git", "init", "-q", "--bare"], cwd=tmp_remote, timeout=60)
+    check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=tmp_remote, timeout=60)
+    check_call(["git", "clone", "-q", tmp_remote, tmp_source], timeout=60)
+    check_call(["git", "checkout", "-q", "-b", "master"], cwd=tmp_source, timeout=60)
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test")
+    for format_id in ["daisy202", "epub3"]:
+        shutil.copytree(os.path.join(test_dir, format_id), os.path.join(tmp_source, format_id))
+    check_call(["git", "add", "-A"], cwd=tmp_source, timeout=60)
+    check_call(["git", "commit", "-q", "-m", "copied test books to archive"], cwd=tmp_source, timeout=60)
+    check_call(["git", "push", "-q", "--set-upstream", "origin", "master"], cwd=tmp_source, timeout=60)
+    check_call(["git", "clone", "-q", tmp_remote, tmp_archive], timeout=60)
+    
+    docker = os.path.join(tmp_archive, ".db", "docker")
+    os.makedirs(os.path.dirname(docker))
+    with open(docker, "w") as f:
+        f.write(TEST_DOCKER % sys.executable)
+    os.chmod(docker, 0o755)
+    
+    args = argparse.Namespace()
+    args.archive = tmp_archive
+    args.forever = False
+    args.enqueue_only = False
+    args.config = os.path.join(os.path.dirname(os.path.realpath(__file__)), "handle_updates.yml")
+    args.output = None
+    args.workers = 2
+    args.max_per_image = 2
+    args.cpus_per_step = 1
+    args.memory_per_step = 256
+    args.docker = docker
+    args.stats_file = None
+    args.log_level = "INFO"
+    args.slots_dir = tmp_slots
+    args.cache = None
+    args.cache_size = 100
+    args.offload_store = None
+    args.offload_threshold = 1000000
+    args.offload_pattern = []
+    args.queue = None
+    args.lease_time = 300
+    args.max_attempts = 1
+    args.retry_delay = 60
     return args
 
 